@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+
+import numpy as np
+from decimal import Decimal
+
+
+def decimal_column(values, default=0.0, precision=8):
+    """Convert a float array to fixed-precision Decimals in one pass, mapping NaN/inf to default"""
+    values = np.asarray(values, dtype=float)
+    values = np.where(np.isfinite(values), values, default)
+    return [Decimal(s) for s in np.char.mod(f'%.{precision}f', values)]
+
+
+class BatchMetadataWriter:
+    """Buffer DynamoDB items and flush them with BatchWriteItem on a background thread.
+
+    ``dynamodb`` is anything exposing ``batch_write_item(RequestItems=...)`` with
+    the boto3 service-resource semantics (Python types in, ``UnprocessedItems``
+    out), so a local stand-in can replace the real resource.
+    """
+
+    def __init__(self, dynamodb, table_name, batch_size=25, max_retries=8, base_delay=0.05, max_pending=10000):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.items_queued = 0
+        self.items_written = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name=f"dynamodb-writer-{table_name}", daemon=True)
+        self._thread.start()
+
+    def put(self, item):
+        """Queue an item; only blocks when max_pending items are already waiting"""
+        if self.error is not None:
+            raise RuntimeError(f"DynamoDB writer failed: {self.error}") from self.error
+        self._queue.put(item)
+        self.items_queued += 1
+
+    def close(self):
+        """Flush everything queued, stop the thread and surface any write error"""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise RuntimeError(f"DynamoDB writer failed: {self.error}") from self.error
+        if self.items_written != self.items_queued:
+            raise RuntimeError(f"DynamoDB writer wrote {self.items_written} of {self.items_queued} items")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closed = True
+                batch = [item for item in batch if item is not None]
+            if batch and self.error is None:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    print(f"Error writing to DynamoDB: {str(e)}")
+                    self.error = e
+
+    def _write_batch(self, items):
+        request = {self.table_name: [{'PutRequest': {'Item': item}} for item in items]}
+        for attempt in range(self.max_retries + 1):
+            response = self.dynamodb.batch_write_item(RequestItems=request)
+            request = response.get('UnprocessedItems') or {}
+            if not request:
+                self.items_written += len(items)
+                return
+            time.sleep(self.base_delay * 2 ** attempt)
+        unprocessed = sum(len(requests) for requests in request.values())
+        raise RuntimeError(f"{unprocessed} items still unprocessed after {self.max_retries} retries")
@@ -0,0 +1,73 @@
+import json
+import resource
+import sys
+import time
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """High-water resident set size in MB (ru_maxrss is KB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+class StageMetrics:
+    """Per-phase timers and counters for one job, emitted as a CloudWatch Embedded
+    Metric Format line so the log line alone publishes the metrics.
+
+    Phases are consecutive: ``lap(phase)`` charges the time since the previous
+    lap (or construction) to phase. Rates are derived at emit time:
+    ``rate(name, counter, phase)`` reports counter / seconds in phase as name.
+    """
+
+    def __init__(self, namespace='MonteCarloPortfolio', dimensions=None, properties=None, emit=print):
+        self.namespace = namespace
+        self.dimensions = dict(dimensions or {})
+        self.properties = dict(properties or {})
+        self.timers = {}
+        self.counters = {}
+        self.rates = []
+        self._emit = emit
+        self._started = self._last_lap = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.timers[phase] = self.timers.get(phase, 0.0) + now - self._last_lap
+        self._last_lap = now
+
+    def count(self, name, value, unit='Count'):
+        self.counters[name] = (self.counters.get(name, (0, unit))[0] + value, unit)
+
+    def rate(self, name, counter, phase):
+        self.rates.append((name, counter, phase))
+
+    def document(self):
+        values, units = {'total_seconds': time.perf_counter() - self._started}, {'total_seconds': 'Seconds'}
+        for phase, seconds in self.timers.items():
+            values[f'{phase}_seconds'], units[f'{phase}_seconds'] = seconds, 'Seconds'
+        for name, (value, unit) in self.counters.items():
+            values[name], units[name] = value, unit
+        for name, counter, phase in self.rates:
+            seconds = self.timers.get(phase)
+            if seconds and counter in self.counters:
+                values[name], units[name] = self.counters[counter][0] / seconds, 'Count/Second'
+        values['peak_rss_mb'], units['peak_rss_mb'] = peak_rss_mb(), 'Megabytes'
+        values['peak_child_rss_mb'], units['peak_child_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN), 'Megabytes'
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in values],
+                }],
+            },
+            **self.dimensions,
+            **self.properties,
+            **values,
+        }
+
+    def emit(self):
+        """Write one JSON metric line and return the document"""
+        document = self.document()
+        self._emit(json.dumps(document))
+        return document
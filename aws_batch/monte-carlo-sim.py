@@ -1,22 +1,70 @@
-import numpy as np
-import pandas as pd
-from datetime import datetime
-from math import exp
-import boto3
-import uuid
-from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 import os
 
+def available_cpus():
+    """CPUs this job may use: the cgroup CPU quota (a Batch job's vCPUs when it is
+    enforced) capped by the affinity mask, rather than the instance's os.cpu_count()"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    for quota_file, period_file in (('/sys/fs/cgroup/cpu.max', None),
+                                    ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')):
+        try:
+            with open(quota_file) as f:
+                fields = f.read().split()
+            if period_file:
+                with open(period_file) as f:
+                    fields.append(f.read().strip())
+            quota, period = fields[0], fields[1]
+        except (OSError, IndexError):
+            continue
+        if quota not in ('max', '-1'):
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+        break
+    return cpus
+
+# Parallelism: one process per available CPU unless NUM_WORKERS says otherwise.
+# Each process then gets one BLAS thread, as the pool already fills every CPU;
+# the limits only take effect if set before numpy loads its BLAS
+num_workers = int(os.getenv('NUM_WORKERS', str(available_cpus())))
+if num_workers > 1:
+    for blas_threads in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ.setdefault(blas_threads, '1')
+
+import numpy as np  # noqa: E402
+from datetime import datetime  # noqa: E402
+from math import exp  # noqa: E402
+import boto3  # noqa: E402
+import uuid  # noqa: E402
+from concurrent.futures import ProcessPoolExecutor  # noqa: E402
+from functools import partial  # noqa: E402
+import json  # noqa: E402
+import io  # noqa: E402
+from streaming_stats import RiskAccumulator  # noqa: E402
+from dynamodb_writer import BatchMetadataWriter, decimal_column  # noqa: E402
+from metrics import StageMetrics  # noqa: E402
+from path_store import PathStore, PathStoreWriter  # noqa: E402
+from result_cache import LocalCacheBackend, ResultCache, S3CacheBackend, cache_key, digest_stream, source_digest  # noqa: E402
+
 region = 'us-east-1'
 s3_client = boto3.client('s3', region_name=region)
 dynamodb = boto3.resource('dynamodb', region_name=region)
 
 # S3 configuration
 bucket = 'monte-carlo-raw-data-william-chang'
-stats_key = 'processed_data/portfolio_stats.csv'
-returns_key = 'processed_data/portfolio_returns.csv'
+# Annualized means, covariance and Cholesky factor from statistical_parameters
+covariance_key = 'processed_data/covariance.npz'
+# 'dense' uses the Cholesky factor; 'factor' samples k PCA factors plus n
+# idiosyncratic shocks, O(n * k) per step for large universes
+covariance_model = os.getenv('COVARIANCE_MODEL', 'dense')
 job_index = os.getenv('AWS_BATCH_JOB_ARRAY_INDEX', '0')
-simulated_results_key = f'processed_data/sim_results_{job_index}.csv'
+# Identifies the array run in every shard so combine_results never merges leftovers
+# of an earlier run; array children share the parent id (AWS_BATCH_JOB_ID is "<parent>:<index>")
+run_id = os.getenv('RUN_ID') or os.getenv('AWS_BATCH_JOB_ID', '').split(':')[0] or None
+simulated_results_key = f'processed_data/sim_results_{job_index}.npz'
+# Compact partial aggregate merged by combine_results instead of the full results
+summary_key = f'processed_data/sim_summary_{job_index}.npz'
+summary_top_k = 100  # Rows kept per job for each of max Sharpe and min volatility
 
 # DynamoDB configuration
 dynamodb_table = 'MonteCarloSimulations'
@@ -26,136 +74,608 @@ opt_dynamodb_table = "OptimalPortfolios"
 num_simulations = 1000
 initial_portfolio_value = 100000
 risk_free_rate = 0.01
-num_portfolios = 10
+num_portfolios = int(os.getenv('NUM_PORTFOLIOS', '10'))
 num_days = 252
 T = 1
+simulation_block_size = 1000  # Most simulations drawn per vectorized block
+# Bytes of float64 normals per block (n_sims x n_steps x shocks per step); large
+# universes get fewer simulations per block. Peak memory per worker is a few times this
+block_memory_budget = int(os.getenv('BLOCK_MEMORY_BYTES', str(128 * 1024 ** 2)))
+# 'independent' draws fresh paths per portfolio; 'shared' scores every portfolio
+# against one scenario matrix (common random numbers)
+simulation_mode = os.getenv('SIMULATION_MODE', 'independent')
+portfolio_block_size = 1000  # Portfolios scored per matmul in shared mode
+# Streaming keeps only online moments and a quantile sketch per portfolio, so
+# memory stays flat in num_simulations. It still grows with the portfolio count:
+# each sketch is ~1845 int64 buckets (~15 KB), about 1.5 GB at 100k portfolios
+stream_statistics = os.getenv('STREAM_STATISTICS', 'false').lower() == 'true'
+# 'pseudo', 'antithetic' or 'sobol' (scrambled, one randomized replicate per
+# block). Sobol drives the leading Brownian-bridge coordinates of each shock, as
+# many as fit scipy's dimension limit, and pseudo-random normals fill the rest;
+# the terminal value is always the first coordinate
+sampling_method = os.getenv('SAMPLING_METHOD', 'pseudo')
+sobol_max_dimension = 21201  # scipy's Sobol direction numbers
+if sampling_method == 'sobol':
+    # Sobol points are only balanced in power-of-two counts; num_simulations is
+    # rounded up to whole blocks (see simulations_to_draw) so the last block is too
+    simulation_block_size = 1024
+# Shift each portfolio's simulated returns so their mean matches the analytic
+# GBM expectation of the portfolio terminal value
+control_variate = os.getenv('CONTROL_VARIATE', 'false').lower() == 'true'
+# Stop drawing blocks once the standard errors of every portfolio's mean return
+# and Sharpe ratio fall below this tolerance (0 disables early stopping)
+convergence_tolerance = float(os.getenv('CONVERGENCE_TOLERANCE', '0'))
+
+# Reproducibility: every random stream is addressed by (seed, job_index, stream,
+# unit), never by worker, so results are bit-identical for any NUM_WORKERS
+simulation_seed = int(os.getenv('SIMULATION_SEED', '0'))
+WEIGHTS_STREAM = 0
+PORTFOLIO_STREAM = 1
+SCENARIO_STREAM = 2
+
+# Persist every shared-mode scenario price path (float32, chunked, compressed)
+# for drawdown analysis and audits; uploaded under path_store_prefix
+persist_paths = os.getenv('PERSIST_PATHS', 'false').lower() == 'true'
+path_store_dir = os.getenv('PATH_STORE_DIR', f'/tmp/path_store_{job_index}')
+path_store_prefix = f'processed_data/path_store_{job_index}/'
+# Path store files are kept in this job's cache entry under this name prefix
+cached_path_prefix = 'path_store.'
+path_chunk_size = 256  # Simulations per chunk file
+
+# Content-addressed cache of this job's outputs: 'off', 'local' (RESULT_CACHE_DIR)
+# or 's3' (result_cache_prefix). A rerun with the same covariance artifact,
+# parameters, seed and code restores the cached files instead of simulating
+result_cache_mode = os.getenv('RESULT_CACHE', 'off')
+result_cache_dir = os.getenv('RESULT_CACHE_DIR', '/tmp/result_cache')
+result_cache_prefix = 'cache/monte-carlo-sim/'
+result_cache_max_bytes = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+# Defaults to a digest of this job's sources; set to e.g. the image digest instead
+code_version = os.getenv('CODE_VERSION')
+source_files = ['monte-carlo-sim.py', 'streaming_stats.py', 'dynamodb_writer.py', 'path_store.py', 'metrics.py']
+
+def gbm_parameters(mean_returns, cov_matrix, num_days, chol=None):
+    """Per-step log drift and Cholesky factor, computed once per job. With chol
+    given, cov_matrix may be None: the variances are the factor's squared row norms"""
+    if chol is None:
+        chol = np.linalg.cholesky(np.asarray(cov_matrix, dtype=float))
+    variance = (chol ** 2).sum(axis=1) if cov_matrix is None else np.diag(np.asarray(cov_matrix, dtype=float))
+    drift = (np.asarray(mean_returns, dtype=float) - 0.5 * variance) / num_days
+    return drift, chol
+
+def factor_parameters(mean_returns, loadings, idiosyncratic_var, num_days):
+    """Per-step log drift and (loadings, idiosyncratic sd) for a covariance B B' + diag(d)"""
+    variance = (loadings ** 2).sum(axis=1) + idiosyncratic_var
+    drift = (np.asarray(mean_returns, dtype=float) - 0.5 * variance) / num_days
+    return drift, (loadings, np.sqrt(idiosyncratic_var))
+
+def shock_dimension(diffusion):
+    """Independent normals needed per asset step: n for a dense factor, k + n for a factor model"""
+    if isinstance(diffusion, tuple):
+        loadings, _ = diffusion
+        return loadings.shape[1] + loadings.shape[0]
+    return diffusion.shape[1]
+
+def correlate_shocks(rand, diffusion):
+    """Map independent normals to correlated asset shocks; O(n * k) per step for a factor model"""
+    if isinstance(diffusion, tuple):
+        loadings, idiosyncratic_sd = diffusion
+        num_factors = loadings.shape[1]
+        return rand[..., :num_factors] @ loadings.T + rand[..., num_factors:] * idiosyncratic_sd
+    return rand @ diffusion.T
+
+def spawn_seed(seed_seq, *key):
+    """Child SeedSequence addressed by key, independent of spawn order"""
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key=seed_seq.spawn_key + key)
+
+def bridge_schedule(n_steps):
+    """(point, left, right) in Brownian-bridge order: the terminal point first, then
+    midpoints of ever finer intervals (left and right are already known)"""
+    schedule, intervals = [(n_steps, 0, None)], [(0, n_steps)]
+    while intervals:
+        left, right = intervals.pop(0)
+        if right - left < 2:
+            continue
+        middle = (left + right) // 2
+        schedule.append((middle, left, right))
+        intervals += [(left, middle), (middle, right)]
+    return schedule
 
-def safe_decimal(value, default=0.0, precision=8):
+def brownian_bridge_increments(z):
+    """Map (n_sims, n_steps, n_shocks) normals in bridge order to i.i.d. standard
+    normal increments, so the leading coordinates carry most of the path variance"""
+    n_sims, n_steps, n_shocks = z.shape
+    walk = np.zeros((n_sims, n_steps + 1, n_shocks))
+    for k, (point, left, right) in enumerate(bridge_schedule(n_steps)):
+        if right is None:
+            walk[:, point] = np.sqrt(point) * z[:, k]
+            continue
+        weight = (point - left) / (right - left)
+        walk[:, point] = ((1 - weight) * walk[:, left] + weight * walk[:, right]
+                          + np.sqrt((point - left) * (right - point) / (right - left)) * z[:, k])
+    return np.diff(walk, axis=1)
+
+def draw_normals(shape, seed_seq):
+    """Standard normals of shape (n_sims, n_steps, n_shocks) using the configured sampling method"""
+    n_sims, n_steps, num_assets = shape
+    if sampling_method == 'sobol':
+        from scipy.stats import qmc
+        from scipy.special import ndtri
+        sobol_steps = min(n_steps, sobol_max_dimension // num_assets)
+        if sobol_steps == 0:
+            raise ValueError(f"SAMPLING_METHOD=sobol supports at most {sobol_max_dimension} shocks per step, "
+                             f"got {num_assets}")
+        sampler = qmc.Sobol(d=sobol_steps * num_assets, scramble=True, seed=np.random.default_rng(spawn_seed(seed_seq, 0)))
+        z = np.empty(shape)
+        # Scrambled points can be exactly 0, where ndtri is -inf; keep them in the open interval
+        uniforms = np.clip(sampler.random(n_sims), 2.0 ** -53, 1.0 - 2.0 ** -53)
+        z[:, :sobol_steps] = ndtri(uniforms).reshape(n_sims, sobol_steps, num_assets)
+        rng = np.random.default_rng(spawn_seed(seed_seq, 1))
+        z[:, sobol_steps:] = rng.standard_normal((n_sims, n_steps - sobol_steps, num_assets))
+        return brownian_bridge_increments(z)
+
+    rng = np.random.default_rng(seed_seq)
+    if sampling_method == 'antithetic':
+        half = rng.standard_normal(((n_sims + 1) // 2, n_steps, num_assets))
+        return np.concatenate([half, -half])[:n_sims]
+    return rng.standard_normal(shape)
+
+def simulate_log_paths(drift, diffusion, rand, num_days):
+    """Log-price paths of shape (n_sims, n_steps + 1, n_assets) starting at 0"""
+    n_sims, n_steps, _ = rand.shape
+    num_assets = len(drift)
+    increments = drift + correlate_shocks(rand, diffusion) * np.sqrt(1 / num_days)
+    log_paths = np.zeros((n_sims, n_steps + 1, num_assets))
+    np.cumsum(increments, axis=1, out=log_paths[:, 1:])
+    return log_paths
+
+def terminal_prices(drift, diffusion, rand, num_days):
+    """Terminal prices straight from the summed normals: the shock map is linear, so
+    no (n_sims, n_steps, n_assets) increments or paths are materialized"""
+    n_steps = rand.shape[1]
+    log_terminal = n_steps * drift + correlate_shocks(rand.sum(axis=1), diffusion) * np.sqrt(1 / num_days)
+    return np.exp(log_terminal)
+
+def simulate_terminal_block(drift, diffusion, n_steps, num_days, n_sims, seed_seq):
+    """Terminal prices for one block of simulations drawn from its own stream"""
+    rand = draw_normals((n_sims, n_steps, shock_dimension(diffusion)), seed_seq)
+    return terminal_prices(drift, diffusion, rand, num_days)
+
+def simulate_path_block(drift, diffusion, n_steps, num_days, n_sims, seed_seq):
+    """Terminal prices plus float32 price paths; the terminal prices are identical to simulate_terminal_block"""
+    rand = draw_normals((n_sims, n_steps, shock_dimension(diffusion)), seed_seq)
+    log_paths = simulate_log_paths(drift, diffusion, rand, num_days)
+    return terminal_prices(drift, diffusion, rand, num_days), np.exp(log_paths).astype(np.float32)
+
+def simulation_block(n_steps, n_shocks):
+    """Simulations per block: simulation_block_size, or fewer when one block's normals
+    would exceed block_memory_budget. Sobol blocks are kept to a power of two"""
+    block_size = max(1, min(simulation_block_size, block_memory_budget // (n_steps * n_shocks * 8)))
+    if sampling_method == 'sobol':
+        block_size = 1 << (block_size.bit_length() - 1)
+    return block_size
+
+def simulations_to_draw(n_sims, block_size):
+    """Simulations to draw per portfolio; Sobol rounds up to whole blocks so each is balanced"""
+    if sampling_method != 'sobol':
+        return n_sims
+    return -(-n_sims // block_size) * block_size
+
+def iter_terminal_blocks(drift, diffusion, n_sims, n_steps, num_days, seed_seq,
+                         block_size=None, executor=None, path_sink=None):
+    """Yield terminal price blocks in order, keeping at most a few blocks in flight.
+    If path_sink is given, it receives each block's full price paths first."""
+    # Read at call time so a module override (e.g. the local runner's --set) applies
+    block_size = block_size or simulation_block(n_steps, shock_dimension(diffusion))
+    if path_sink is not None:
+        blocks = iter_terminal_blocks_with(simulate_path_block, drift, diffusion, n_sims, n_steps, num_days,
+                                           seed_seq, block_size, executor)
+        for terminal_prices, paths in blocks:
+            path_sink(paths)
+            yield terminal_prices
+        return
+    yield from iter_terminal_blocks_with(simulate_terminal_block, drift, diffusion, n_sims, n_steps, num_days,
+                                         seed_seq, block_size, executor)
+
+def iter_terminal_blocks_with(block_function, drift, diffusion, n_sims, n_steps, num_days, seed_seq,
+                              block_size, executor):
+    block_starts = range(0, n_sims, block_size)
+    simulate_block = partial(block_function, drift, diffusion, n_steps, num_days)
+    if executor is None:
+        for i, start in enumerate(block_starts):
+            yield simulate_block(min(block_size, n_sims - start), spawn_seed(seed_seq, i))
+        return
+
+    window = 2 * num_workers
+    pending = []
     try:
-        if pd.isna(value) or not np.isfinite(value):
-            value = default
-        d = Decimal(str(value))
-        quantizer = Decimal("1." + "0" * precision)
-        return d.quantize(quantizer, rounding=ROUND_HALF_UP)
-    except (InvalidOperation, ValueError, TypeError) as e:
-        return Decimal(str(default)).quantize(Decimal("1." + "0" * precision), rounding=ROUND_HALF_UP)
-
-def read_data_from_s3(bucket, key):
+        for i, start in enumerate(block_starts):
+            pending.append(executor.submit(simulate_block, min(block_size, n_sims - start), spawn_seed(seed_seq, i)))
+            if len(pending) >= window:
+                yield pending.pop(0).result()
+        while pending:
+            yield pending.pop(0).result()
+    finally:
+        # Early stopping abandons the generator; drop blocks nobody will read
+        for future in pending:
+            future.cancel()
+
+def risk_metrics(expected_returns, volatility, prob_loss, var_95, cvar_95):
+    """Add the Sharpe ratio to per-portfolio moments and tail metrics"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = (expected_returns - risk_free_rate) / volatility
+    return expected_returns, volatility, sharpe, prob_loss, var_95, cvar_95
+
+def portfolio_statistics(simulated_returns, expected_returns=None):
+    """Risk metrics per column of a (n_sims, n_portfolios) simulated return matrix"""
+    if expected_returns is not None:
+        simulated_returns = simulated_returns + (expected_returns - simulated_returns.mean(axis=0))
+    expected_returns = simulated_returns.mean(axis=0)
+    volatility = simulated_returns.std(axis=0)
+    prob_loss = np.mean(simulated_returns < 0, axis=0)
+    var_95 = np.percentile(simulated_returns, 5, axis=0)
+    cvar_95 = np.nanmean(np.where(simulated_returns <= var_95, simulated_returns, np.nan), axis=0)
+    return risk_metrics(expected_returns, volatility, prob_loss, var_95, cvar_95)
+
+def evaluate_portfolios(scenarios, weights_matrix, expected_returns=None, block_size=None):
+    """Score a (n_portfolios, n_assets) weights matrix against shared (n_sims, n_assets) scenario returns"""
+    block_size = block_size or portfolio_block_size
+    metrics = [np.empty(len(weights_matrix)) for _ in range(6)]
+    for start in range(0, len(weights_matrix), block_size):
+        stop = min(start + block_size, len(weights_matrix))
+        block_expected = None if expected_returns is None else expected_returns[start:stop]
+        block_stats = portfolio_statistics(scenarios @ weights_matrix[start:stop].T, block_expected)
+        for metric, values in zip(metrics, block_stats):
+            metric[start:stop] = values
+    return metrics
+
+def has_converged(count, mean, variance):
+    """True once the standard errors of mean return and Sharpe are within tolerance for every portfolio"""
+    volatility = np.sqrt(variance)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = (mean - risk_free_rate) / volatility
+    # Lo (2002): SE(Sharpe) ~ sqrt((1 + S^2 / 2) / n) for i.i.d. returns
+    return_se = volatility / np.sqrt(count)
+    sharpe_se = np.sqrt((1 + 0.5 * sharpe ** 2) / count)
+    return bool(np.all(return_se < convergence_tolerance) and np.all(sharpe_se < convergence_tolerance))
+
+def score_portfolios(terminal_blocks, weights_matrix, expected_returns=None, block_size=None):
+    """Consume terminal price blocks in order; return risk metrics per portfolio and simulations used"""
+    block_size = block_size or portfolio_block_size
+    portfolio_slices = [slice(start, start + block_size) for start in range(0, len(weights_matrix), block_size)]
+    accumulators = [RiskAccumulator(len(weights_matrix[block])) for block in portfolio_slices] if stream_statistics else []
+    scenario_blocks = []
+    count, sums, sums_sq = 0, np.zeros(len(weights_matrix)), np.zeros(len(weights_matrix))
+
+    for terminal_prices in terminal_blocks:
+        count += len(terminal_prices)
+        if stream_statistics:
+            for block, accumulator in zip(portfolio_slices, accumulators):
+                accumulator.update(terminal_prices @ weights_matrix[block].T - 1.0)
+        else:
+            scenario_blocks.append(terminal_prices)
+
+        if convergence_tolerance > 0:
+            if stream_statistics:
+                mean = np.concatenate([accumulator.mean for accumulator in accumulators])
+                variance = np.concatenate([accumulator.variance() for accumulator in accumulators])
+            else:
+                for block in portfolio_slices:
+                    block_returns = terminal_prices @ weights_matrix[block].T - 1.0
+                    sums[block] += block_returns.sum(axis=0)
+                    sums_sq[block] += (block_returns ** 2).sum(axis=0)
+                mean = sums / count
+                variance = np.maximum(sums_sq / count - mean ** 2, 0.0)
+            if has_converged(count, mean, variance):
+                break
+
+    if stream_statistics:
+        statistics = []
+        for block, accumulator in zip(portfolio_slices, accumulators):
+            shift = None if expected_returns is None else expected_returns[block] - accumulator.mean
+            statistics.append(accumulator.statistics(shift=shift))
+        return risk_metrics(*(np.concatenate(metric) for metric in zip(*statistics))), count
+
+    scenarios = np.concatenate(scenario_blocks) - 1.0
+    return evaluate_portfolios(scenarios, weights_matrix, expected_returns, block_size), count
+
+def simulate_portfolio(drift, diffusion, n_sims, n_steps, num_days, weights, expected_return, seed_seq):
+    """Independent-mode worker: fresh paths and risk metrics for one portfolio"""
+    terminal_blocks = iter_terminal_blocks(drift, diffusion, n_sims, n_steps, num_days, seed_seq)
+    expected_returns = None if expected_return is None else np.array([expected_return])
+    metrics, count = score_portfolios(terminal_blocks, weights[None, :], expected_returns)
+    return [float(metric[0]) for metric in metrics], count
+
+def covariance_arrays():
+    """Artifact arrays the configured covariance model simulates from"""
+    if covariance_model == 'factor':
+        return ['mean_returns', 'asset_names', 'factor_loadings', 'idiosyncratic_var']
+    return ['mean_returns', 'asset_names', 'cholesky']
+
+def read_covariance_from_s3(bucket, key, names):
+    """Load the named arrays of the covariance artifact (those present), plus a digest
+    of its bytes. The file is spooled to /tmp so unused dense n x n arrays never load"""
     try:
+        local_file = '/tmp/' + os.path.basename(key)
         response = s3_client.get_object(Bucket=bucket, Key=key)
-        data = pd.read_csv(response['Body'], index_col=0)
-        return data
+        with open(local_file, 'wb') as f:
+            digest = digest_stream(response['Body'], f)
+        with np.load(local_file, allow_pickle=False) as artifact:
+            return {name: artifact[name] for name in names if name in artifact.files}, digest
     except Exception as e:
         print(f"Error reading from S3: {str(e)}")
         raise
 
-def write_results_to_s3(bucket, key, df):
+def write_results_to_s3(bucket, key, columns, metadata):
+    """Upload typed result columns as .npz: one array per column, one float column per
+    asset weight (weight_<asset>), and run parameters as JSON under __metadata__"""
     try:
-        local_file = f'/tmp/sim_results_{job_index}.csv'
-        df.to_csv(local_file)
+        local_file = '/tmp/' + os.path.basename(key)
+        np.savez(local_file, __metadata__=np.array(json.dumps(metadata)), **columns)
         s3_client.upload_file(local_file, bucket, key)
         return f"s3://{bucket}/{key}"
     except Exception as e:
         print(f"Error writing to S3: {str(e)}")
         raise
     
-def write_metadata_to_dynamodb(table_name, simulation_id, run_date,
-                               initial_portfolio_value, num_simulations, returns, volatility,
-                               sharpe, prob_loss, VaR_95, weights, num_days, status):
-    try:
-        table = dynamodb.Table(table_name)
+def restamp_results(data, **fields):
+    """Results .npz bytes with fields updated in __metadata__ (a cached shard joining a new run)"""
+    with np.load(io.BytesIO(data), allow_pickle=False) as results:
+        columns = {name: results[name] for name in results.files}
+    metadata = dict(json.loads(str(columns.pop('__metadata__'))), **fields)
+    buffer = io.BytesIO()
+    np.savez(buffer, __metadata__=np.array(json.dumps(metadata)), **columns)
+    return buffer.getvalue()
 
-        item = {
+def upload_directory_to_s3(bucket, prefix, directory, names=None):
+    """Upload the named files (default: every file) of a flat directory under an S3 prefix"""
+    for name in sorted(os.listdir(directory) if names is None else names):
+        s3_client.upload_file(os.path.join(directory, name), bucket, prefix + name)
+    return f"s3://{bucket}/{prefix}"
+
+def open_result_cache():
+    if result_cache_mode == 'local':
+        return ResultCache(LocalCacheBackend(result_cache_dir), max_bytes=result_cache_max_bytes)
+    if result_cache_mode == 's3':
+        return ResultCache(S3CacheBackend(s3_client, bucket, result_cache_prefix), max_bytes=result_cache_max_bytes)
+    return None
+
+def run_cache_key(covariance_digest):
+    """Cache key over everything that determines this job's output files"""
+    parameters = {
+        'job_index': int(job_index),
+        'num_simulations': num_simulations,
+        'num_portfolios': num_portfolios,
+        'initial_portfolio_value': initial_portfolio_value,
+        'risk_free_rate': risk_free_rate,
+        'num_days': num_days,
+        'T': T,
+        'simulation_block_size': simulation_block_size,
+        'block_memory_budget': block_memory_budget,
+        'portfolio_block_size': portfolio_block_size,
+        'summary_top_k': summary_top_k,
+        'simulation_mode': simulation_mode,
+        'stream_statistics': stream_statistics,
+        'sampling_method': sampling_method,
+        'control_variate': control_variate,
+        'convergence_tolerance': convergence_tolerance,
+        'covariance_model': covariance_model,
+        'persist_paths': persist_paths,
+        'seed': simulation_seed,
+    }
+    here = os.path.dirname(os.path.abspath(__file__))
+    version = code_version or source_digest([os.path.join(here, name) for name in source_files])
+    return cache_key('monte-carlo-sim', {covariance_key: covariance_digest}, parameters, version)
+
+# pareto_front_indices and summarize_results are copied in
+# aws_lambda/combine_results/combine_results.py; keep both copies identical
+def pareto_front_indices(volatility, returns):
+    """Indices of portfolios no other portfolio beats on both lower volatility and higher return"""
+    candidates = np.flatnonzero(np.isfinite(volatility) & np.isfinite(returns))
+    # Volatility ascending, ties broken by return descending
+    order = candidates[np.lexsort((-returns[candidates], volatility[candidates]))]
+    best_before = np.maximum.accumulate(np.concatenate([[-np.inf], returns[order][:-1]]))
+    return order[returns[order] > best_before]
+
+def summarize_results(columns, top_k=summary_top_k):
+    """Partial aggregate: top-k rows by Sharpe, bottom-k by volatility and the Pareto frontier.
+
+    Merging two summaries is summarize_results over their concatenation, so
+    shards reduce in any tree shape to the same global answer.
+    """
+    sharpe = np.where(np.isnan(columns['sharpe_ratio']), -np.inf, columns['sharpe_ratio'])
+    volatility = np.where(np.isnan(columns['volatility']), np.inf, columns['volatility'])
+    k = min(top_k, len(sharpe))
+    top_sharpe = np.argpartition(-sharpe, k - 1)[:k] if k else []
+    low_volatility = np.argpartition(volatility, k - 1)[:k] if k else []
+    frontier = pareto_front_indices(columns['volatility'], columns['returns'])
+    keep = np.unique(np.concatenate([top_sharpe, low_volatility, frontier]).astype(np.int64))
+    return {name: column[keep] for name, column in columns.items()}
+
+def metadata_items(simulation_ids, run_date, simulations_used, metric_columns, weights_matrix, asset_names, status):
+    """DynamoDB items for every portfolio, with numeric columns converted to Decimal in bulk"""
+    returns, volatility, sharpe, prob_loss, var_95, cvar_95 = (decimal_column(column) for column in metric_columns)
+    weight_columns = [decimal_column(column) for column in weights_matrix.T]
+    for i, simulation_id in enumerate(simulation_ids):
+        yield {
             'SimulationID': simulation_id,
             'RunDate': run_date,
             'InitialValue': int(initial_portfolio_value),
-            'NumSimulations': int(num_simulations),
-            'ExpectedReturns': safe_decimal(returns),
-            'Volatility': safe_decimal(volatility),
-            'Sharpe': safe_decimal(sharpe),
-            'VaR_95': safe_decimal(VaR_95),
-            'ProbabilityLoss': safe_decimal(prob_loss),
-            'Weights': {k: safe_decimal(v) for k, v in weights.items()},
+            'NumSimulations': int(simulations_used[i]),
+            'ExpectedReturns': returns[i],
+            'Volatility': volatility[i],
+            'Sharpe': sharpe[i],
+            'VaR_95': var_95[i],
+            'CVaR_95': cvar_95[i],
+            'ProbabilityLoss': prob_loss[i],
+            'Weights': {asset: column[i] for asset, column in zip(asset_names, weight_columns)},
             'TimeHorizon': int(num_days),
             'Status': status
         }
 
-        table.put_item(Item=item)
-    except Exception as e:
-        print(f"Error writing to DynamoDB: {str(e)}")
-        raise
-
 
 def main():
     try:
         print("Starting Monte Carlo simulation batch job at " + datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         run_date = datetime.now().strftime('%Y-%m-%d')
+        # One structured metric line per job: phase timers, throughput and peak RSS
+        metrics = StageMetrics(dimensions={'Stage': 'monte-carlo-sim', 'SimulationMode': simulation_mode},
+                               properties={'JobIndex': int(job_index), 'NumWorkers': num_workers})
 
-        stats = read_data_from_s3(bucket, stats_key)
-        returns = read_data_from_s3(bucket, returns_key)
+        covariance, covariance_digest = read_covariance_from_s3(bucket, covariance_key, covariance_arrays())
+        metrics.lap('load')
 
-        mean_returns = stats['MeanReturn_Annual'].values
-        cov_matrix = returns.cov() * 252
-        num_assets = len(mean_returns)
-        asset_names = stats.index.tolist()
-
-        results = {
-            'simulation_id': [],
-            'run_date': run_date,
-            'initial_portfolio_value': initial_portfolio_value,
-            'num_simulations': num_simulations,
-            'returns': [],
-            'volatility': [],
-            'sharpe_ratio': [],
-            'prob_loss': [],
-            'VaR_95': [],
-            'weights': [],
-        }
+        result_cache = open_result_cache()
+        if result_cache:
+            run_key = run_cache_key(covariance_digest)
+            cached = result_cache.lookup(run_key)
+            if cached is not None:
+                # DynamoDB items were written by the run that filled the cache
+                for key in (simulated_results_key, summary_key):
+                    restored = restamp_results(cached[os.path.basename(key)], run_id=run_id, run_date=run_date)
+                    s3_client.upload_fileobj(io.BytesIO(restored), bucket, key)
+                for name, data in sorted(cached.items()):
+                    if name.startswith(cached_path_prefix):
+                        s3_client.upload_fileobj(io.BytesIO(data), bucket,
+                                                 path_store_prefix + name[len(cached_path_prefix):])
+                print(f"Restored cached results {run_key[:12]} for job {job_index}; simulation skipped")
+                metrics.lap('cache_restore')
+                metrics.count('cache_hits', 1)
+                metrics.emit()
+                return {'statusCode': 200, 'body': f"Restored {num_portfolios} cached simulations"}
 
-        for _ in range(num_portfolios):
-            simulation_id = f"sim_{uuid.uuid4()}"
-            weights = np.random.dirichlet(np.ones(num_assets), 1)[0]
-            weights_dict = {asset: float(w) for asset, w in zip(asset_names, weights)}
+        mean_returns = covariance['mean_returns']
+        num_assets = len(mean_returns)
+        asset_names = [str(name) for name in covariance['asset_names']]
+        num_steps = T * num_days
+        if covariance_model == 'factor':
+            drift, diffusion = factor_parameters(mean_returns, covariance['factor_loadings'],
+                                                 covariance['idiosyncratic_var'], num_days)
+        elif 'cholesky' not in covariance:
+            raise ValueError(f"Covariance of {num_assets} assets is not positive definite; "
+                             "set COVARIANCE_MODEL=factor to simulate it")
+        else:
+            drift, diffusion = gbm_parameters(mean_returns, None, num_days, covariance['cholesky'])
+        # Analytic GBM expectation: E[S_T / S_0] = exp(mu * T) for each asset
+        expected_terminal = np.exp(mean_returns * num_steps / num_days)
 
-            simulated_returns = []
-            for _ in range(num_simulations):
-                prices = np.ones((T * num_days + 1, num_assets))
-                for t in range(1, T * num_days + 1):
-                    rand = np.random.normal(0, 1, num_assets)
-                    variance = np.diag(cov_matrix.values)
-                    drift = (mean_returns - 0.5 * variance) / num_days
-                    diffusion = np.dot(np.linalg.cholesky(cov_matrix), rand) * np.sqrt(1 / num_days)
-                    prices[t] = prices[t - 1] * np.exp(drift + diffusion)
+        if persist_paths and simulation_mode != 'shared':
+            raise ValueError("PERSIST_PATHS requires SIMULATION_MODE=shared (paths are the shared scenarios)")
 
-                final_return = np.dot(prices[-1], weights) - 1.0
-                simulated_returns.append(final_return)
+        block_size = simulation_block(num_steps, shock_dimension(diffusion))
+        n_sims = simulations_to_draw(num_simulations, block_size)
+        if n_sims != num_simulations:
+            print(f"Rounded {num_simulations} simulations up to {n_sims} (whole Sobol blocks of {block_size})")
 
-            simulated_returns = np.array(simulated_returns)
+        root_seed = np.random.SeedSequence(simulation_seed, spawn_key=(int(job_index),))
+        weights_rng = np.random.default_rng(spawn_seed(root_seed, WEIGHTS_STREAM))
+        weights_matrix = weights_rng.dirichlet(np.ones(num_assets), num_portfolios)
+        analytic_returns = weights_matrix @ expected_terminal - 1.0 if control_variate else None
 
-            expected_returns = simulated_returns.mean()
-            volatility = simulated_returns.std()
-            sharpe = (expected_returns - risk_free_rate) / volatility
-            prob_loss = np.mean(simulated_returns < 0)
-            var_95 = np.percentile(simulated_returns, 5)
+        executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+        try:
+            if simulation_mode == 'shared':
+                # Weights are a linear map of terminal asset returns, so one scenario
+                # matrix and a GEMM score every portfolio on common random numbers
+                path_writer = PathStoreWriter(path_store_dir, num_steps, asset_names, path_chunk_size) if persist_paths else None
+                path_sink = None
+                if path_writer:
+                    def path_sink(paths):
+                        first = path_writer.num_paths
+                        path_writer.append([f"path_{job_index}_{first + i}" for i in range(len(paths))], paths)
+                terminal_blocks = iter_terminal_blocks(drift, diffusion, n_sims, num_steps, num_days,
+                                                       spawn_seed(root_seed, SCENARIO_STREAM), executor=executor,
+                                                       path_sink=path_sink)
+                metric_columns, simulation_count = score_portfolios(terminal_blocks, weights_matrix, analytic_returns)
+                simulations_used = [simulation_count] * num_portfolios
+                if path_writer:
+                    path_writer.close()
+            else:
+                simulate = partial(simulate_portfolio, drift, diffusion, n_sims, num_steps, num_days)
+                portfolio_seeds = [spawn_seed(root_seed, PORTFOLIO_STREAM, i) for i in range(num_portfolios)]
+                portfolio_expected = analytic_returns if control_variate else [None] * num_portfolios
+                portfolio_args = (weights_matrix, portfolio_expected, portfolio_seeds)
+                if executor:
+                    chunksize = max(1, num_portfolios // (num_workers * 4))
+                    portfolio_metrics = list(executor.map(simulate, *portfolio_args, chunksize=chunksize))
+                else:
+                    portfolio_metrics = list(map(simulate, *portfolio_args))
+                simulations_used = [count for _, count in portfolio_metrics]
+                metric_columns = [np.array(column) for column in zip(*(metrics for metrics, _ in portfolio_metrics))]
+        finally:
+            if executor:
+                executor.shutdown()
+        metrics.lap('simulate')
+        metrics.count('portfolios', num_portfolios)
+        # Shared mode scores every portfolio on the same paths
+        metrics.count('paths', simulations_used[0] if simulation_mode == 'shared' else sum(simulations_used))
+        metrics.rate('paths_per_second', 'paths', 'simulate')
+        metrics.rate('portfolios_per_second', 'portfolios', 'simulate')
 
-            results['simulation_id'].append(simulation_id)
-            results['returns'].append(expected_returns)
-            results['volatility'].append(volatility)
-            results['sharpe_ratio'].append(sharpe)
-            results['prob_loss'].append(prob_loss)
-            results['VaR_95'].append(var_95)
-            results['weights'].append(weights_dict)
+        simulation_ids = [f"sim_{uuid.uuid4()}" for _ in range(num_portfolios)]
+        expected_returns, volatility, sharpe, prob_loss, var_95, cvar_95 = metric_columns
 
-            write_metadata_to_dynamodb(
-                dynamodb_table, simulation_id, run_date, initial_portfolio_value, num_simulations,
-                expected_returns, volatility, sharpe, prob_loss, var_95, weights_dict, num_days, "Completed"
-            )
+        # Metadata drains to DynamoDB in the background while the results file is written
+        metadata_writer = BatchMetadataWriter(dynamodb, dynamodb_table)
+        try:
+            for item in metadata_items(simulation_ids, run_date, simulations_used, metric_columns,
+                                       weights_matrix, asset_names, "Completed"):
+                metadata_writer.put(item)
 
-        results_df = pd.DataFrame(results)
+            results_columns = {
+                'simulation_id': np.array(simulation_ids),
+                'num_simulations': np.array(simulations_used, dtype=np.int64),
+                'returns': expected_returns,
+                'volatility': volatility,
+                'sharpe_ratio': sharpe,
+                'prob_loss': prob_loss,
+                'VaR_95': var_95,
+                'CVaR_95': cvar_95,
+            }
+            for asset, column in zip(asset_names, weights_matrix.T):
+                results_columns[f'weight_{asset}'] = column
+            if persist_paths:
+                # Path metrics stream over the store one chunk at a time
+                path_store = PathStore(path_store_dir)
+                results_columns['max_drawdown'], results_columns['time_under_water'] = path_store.drawdowns(weights_matrix)
+                print(f"Stored {len(path_store)} paths at " + upload_directory_to_s3(bucket, path_store_prefix, path_store_dir, path_store.files()))
+            results_metadata = {
+                'asset_names': asset_names,
+                'run_date': run_date,
+                'initial_portfolio_value': initial_portfolio_value,
+                'num_days': num_days,
+                'T': T,
+                'risk_free_rate': risk_free_rate,
+                'seed': simulation_seed,
+                'job_index': int(job_index),
+                'run_id': run_id,
+                'simulation_mode': simulation_mode,
+                'sampling_method': sampling_method,
+                'covariance_model': covariance_model,
+                'control_variate': control_variate,
+                'persist_paths': persist_paths,
+            }
 
-        write_results_to_s3(bucket, simulated_results_key, results_df)
+            write_results_to_s3(bucket, simulated_results_key, results_columns, results_metadata)
+            summary_metadata = dict(results_metadata, num_portfolios=num_portfolios, top_k=summary_top_k)
+            write_results_to_s3(bucket, summary_key, summarize_results(results_columns), summary_metadata)
+        finally:
+            metadata_writer.close()
+        metrics.lap('write_results')
 
+        if result_cache:
+            cached = {}
+            for key in (simulated_results_key, summary_key):
+                with open('/tmp/' + os.path.basename(key), 'rb') as f:
+                    cached[os.path.basename(key)] = f.read()
+            if persist_paths:
+                # A hit must restore the path store too, or the new run would have none
+                for name in PathStore(path_store_dir).files():
+                    with open(os.path.join(path_store_dir, name), 'rb') as f:
+                        cached[cached_path_prefix + name] = f.read()
+            result_cache.store(run_key, cached)
+            metrics.lap('cache_store')
 
+        metrics.emit()
         print(f"All {num_portfolios} portfolio simulations completed at " + datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         return {'statusCode': 200, 'body': f"Completed {num_portfolios} simulations"}
     except Exception as e:
@@ -0,0 +1,173 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+
+def shuffle_bytes(chunk):
+    """Group the i-th byte of every float together so exponents compress well (as blosc does)"""
+    return np.ascontiguousarray(chunk).view(np.uint8).reshape(-1, chunk.dtype.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data, dtype, shape):
+    itemsize = np.dtype(dtype).itemsize
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(shape)
+
+
+def drawdown_metrics(values):
+    """Max drawdown and fraction of steps under water per path for (n_paths, n_steps + 1, ...) values"""
+    running_peak = np.maximum.accumulate(values, axis=1)
+    max_drawdown = (1.0 - values / running_peak).max(axis=1)
+    time_under_water = (values < running_peak).mean(axis=1)
+    return max_drawdown, time_under_water
+
+
+class PathStoreWriter:
+    """Append float32 price paths (n_sims, n_steps + 1, n_assets) into fixed-size chunk files.
+
+    Layout of ``directory``: ``manifest.json`` (shape, chunking, codec, asset
+    names), ``ids.npy`` (simulation_id per row, in order) and one file per
+    chunk of ``chunk_size`` simulations. With ``compression='zlib'`` chunks are
+    byte-shuffled and deflated; with ``compression=None`` they are plain .npy
+    files that the reader memory-maps. Only the current partial chunk is held
+    in memory while writing.
+    """
+
+    def __init__(self, directory, num_steps, asset_names, chunk_size=256, compression='zlib', level=1):
+        if compression not in ('zlib', None):
+            raise ValueError(f"Unsupported path store compression: {compression}")
+        self.directory = directory
+        self.path_shape = (num_steps + 1, len(asset_names))
+        self.asset_names = list(asset_names)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.level = level
+        self.num_paths = 0
+        self.num_chunks = 0
+        self._ids = []
+        self._buffer = []
+        self._buffered = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, simulation_ids, paths):
+        paths = np.asarray(paths, dtype=np.float32)
+        if paths.shape[1:] != self.path_shape or len(paths) != len(simulation_ids):
+            raise ValueError(f"Expected {len(simulation_ids)} paths of shape {self.path_shape}, got {paths.shape}")
+        self._ids.extend(str(simulation_id) for simulation_id in simulation_ids)
+        self._buffer.append(paths)
+        self._buffered += len(paths)
+        self.num_paths += len(paths)
+        while self._buffered >= self.chunk_size:
+            pending = np.concatenate(self._buffer)
+            self._write_chunk(pending[:self.chunk_size])
+            rest = pending[self.chunk_size:]
+            self._buffer, self._buffered = ([rest] if len(rest) else []), len(rest)
+
+    def close(self):
+        """Flush the last partial chunk and write the index and manifest"""
+        if self._buffered:
+            self._write_chunk(np.concatenate(self._buffer))
+            self._buffer, self._buffered = [], 0
+        np.save(os.path.join(self.directory, 'ids.npy'), np.array(self._ids))
+        manifest = {
+            'shape': [self.num_paths, *self.path_shape],
+            'dtype': 'float32',
+            'chunk_size': self.chunk_size,
+            'num_chunks': self.num_chunks,
+            'compression': self.compression,
+            'asset_names': self.asset_names,
+        }
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        return self.directory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+    def _write_chunk(self, chunk):
+        name = chunk_file(self.num_chunks, self.compression)
+        if self.compression == 'zlib':
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(zlib.compress(shuffle_bytes(chunk), self.level))
+        else:
+            np.save(os.path.join(self.directory, name), chunk)
+        self.num_chunks += 1
+
+
+def chunk_file(index, compression):
+    return f'chunk_{index:06d}.zlib' if compression == 'zlib' else f'chunk_{index:06d}.npy'
+
+
+class PathStore:
+    """Read side of a path store: random access to one path by simulation_id and
+    streaming over chunks, decoding a single chunk at a time."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.shape = tuple(self.manifest['shape'])
+        self.chunk_size = self.manifest['chunk_size']
+        self.asset_names = self.manifest['asset_names']
+        self.ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')
+        self._rows = None
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk(self, index):
+        """Decoded chunk as a (rows, n_steps + 1, n_assets) float32 array (memory-mapped if uncompressed)"""
+        if self._cached[0] == index:
+            return self._cached[1]
+        path = os.path.join(self.directory, chunk_file(index, self.manifest['compression']))
+        rows = min(self.chunk_size, self.shape[0] - index * self.chunk_size)
+        if self.manifest['compression'] == 'zlib':
+            with open(path, 'rb') as f:
+                chunk = unshuffle_bytes(zlib.decompress(f.read()), np.float32, (rows, *self.shape[1:]))
+        else:
+            chunk = np.load(path, mmap_mode='r')
+        self._cached = (index, chunk)
+        return chunk
+
+    def path_at(self, row):
+        chunk_index, offset = divmod(row, self.chunk_size)
+        return np.array(self.chunk(chunk_index)[offset])
+
+    def path(self, simulation_id):
+        """Price path (n_steps + 1, n_assets) for one simulation_id"""
+        if self._rows is None:
+            self._rows = {str(simulation_id): row for row, simulation_id in enumerate(self.ids)}
+        return self.path_at(self._rows[str(simulation_id)])
+
+    def files(self):
+        """Names of the files that make up this store. A reused directory may also hold
+        chunks of an earlier, larger store, so copy these rather than the directory"""
+        compression = self.manifest['compression']
+        return ['manifest.json', 'ids.npy'] + [chunk_file(index, compression)
+                                               for index in range(self.manifest['num_chunks'])]
+
+    def iter_chunks(self):
+        """Yield (first_row, chunk) in order without holding more than one chunk"""
+        for index in range(self.manifest['num_chunks']):
+            yield index * self.chunk_size, self.chunk(index)
+
+    def drawdowns(self, weights_matrix, portfolio_block_size=64):
+        """Per-portfolio mean max drawdown and mean time under water over every stored path,
+        for buy-and-hold portfolios (n_portfolios, n_assets) on unit initial prices"""
+        weights_matrix = np.asarray(weights_matrix, dtype=np.float32)
+        max_drawdown = np.zeros(len(weights_matrix))
+        time_under_water = np.zeros(len(weights_matrix))
+        for _, chunk in self.iter_chunks():
+            for start in range(0, len(weights_matrix), portfolio_block_size):
+                block = slice(start, start + portfolio_block_size)
+                drawdown, under_water = drawdown_metrics(chunk @ weights_matrix[block].T)
+                max_drawdown[block] += drawdown.sum(axis=0)
+                time_under_water[block] += under_water.sum(axis=0)
+        return max_drawdown / len(self), time_under_water / len(self)
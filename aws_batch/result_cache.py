@@ -0,0 +1,190 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+
+
+def digest_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_stream(stream, sink, chunk_size=1 << 20):
+    """Copy a file-like stream into sink in chunks, returning the digest of its bytes"""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        h.update(chunk)
+        sink.write(chunk)
+    return h.hexdigest()
+
+
+def source_digest(paths):
+    """Code version as a digest of the given source files (order-sensitive)"""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(os.path.basename(path).encode())
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def cache_key(stage, input_digests, parameters, code_version):
+    """Content address of a stage run: same inputs, parameters and code give the same key"""
+    payload = json.dumps({
+        'stage': stage,
+        'inputs': input_digests,
+        'parameters': parameters,
+        'code_version': code_version,
+    }, sort_keys=True, default=str)
+    return digest_bytes(payload.encode())
+
+
+class LocalCacheBackend:
+    """Entries are directories <root>/<key>/ of result files; the directory mtime is the last use.
+
+    Entries are staged in .<key>.tmp/ and renamed into place. Staging directories
+    of puts that crashed are not entries, so put removes any older than
+    ``stale_after`` seconds (long enough not to race a put still writing).
+    """
+
+    def __init__(self, root, stale_after=3600):
+        self.root = root
+        self.stale_after = stale_after
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, key):
+        entry = os.path.join(self.root, key)
+        if not os.path.isdir(entry):
+            return None
+        files = {}
+        for name in os.listdir(entry):
+            with open(os.path.join(entry, name), 'rb') as f:
+                files[name] = f.read()
+        os.utime(entry)
+        return files
+
+    def put(self, key, files):
+        self.purge_staging()
+        staging = os.path.join(self.root, f'.{key}.tmp')
+        try:
+            os.makedirs(staging, exist_ok=True)
+            for name, data in files.items():
+                with open(os.path.join(staging, name), 'wb') as f:
+                    f.write(data)
+            # Rename is atomic, so a concurrent reader never sees a partial entry
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            os.replace(staging, os.path.join(self.root, key))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def purge_staging(self):
+        """Remove staging directories left behind by puts that died before their rename"""
+        cutoff = time.time() - self.stale_after
+        for name in os.listdir(self.root):
+            staging = os.path.join(self.root, name)
+            if name.startswith('.') and name.endswith('.tmp') and os.path.isdir(staging):
+                try:
+                    if os.path.getmtime(staging) < cutoff:
+                        shutil.rmtree(staging, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+
+    def entries(self):
+        """(key, size_bytes, last_used) for every entry"""
+        result = []
+        for key in os.listdir(self.root):
+            entry = os.path.join(self.root, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            result.append((key, size, os.path.getmtime(entry)))
+        return result
+
+    def delete(self, key):
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+
+class S3CacheBackend:
+    """Entries are objects <prefix><key>/<name> plus a <prefix><key>/.last_used marker
+    rewritten on every hit, so LastModified of the marker orders entries by use."""
+
+    marker = '.last_used'
+
+    def __init__(self, s3_client, bucket, prefix):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _list(self, prefix):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield from page.get('Contents', [])
+
+    def get(self, key):
+        objects = [obj for obj in self._list(f'{self.prefix}{key}/')]
+        names = [obj['Key'].rsplit('/', 1)[-1] for obj in objects]
+        # The marker is written last, so an entry without it is incomplete
+        if self.marker not in names:
+            return None
+        files = {}
+        for obj, name in zip(objects, names):
+            if name != self.marker:
+                files[name] = self.s3_client.get_object(Bucket=self.bucket, Key=obj['Key'])['Body'].read()
+        self._touch(key)
+        return files
+
+    def put(self, key, files):
+        for name, data in files.items():
+            self.s3_client.upload_fileobj(io.BytesIO(data), self.bucket, f'{self.prefix}{key}/{name}')
+        self._touch(key)
+
+    def _touch(self, key):
+        self.s3_client.upload_fileobj(io.BytesIO(str(time.time()).encode()), self.bucket,
+                                      f'{self.prefix}{key}/{self.marker}')
+
+    def entries(self):
+        sizes, last_used = {}, {}
+        for obj in self._list(self.prefix):
+            key, name = obj['Key'][len(self.prefix):].split('/', 1)
+            sizes[key] = sizes.get(key, 0) + obj['Size']
+            if name == self.marker:
+                last_used[key] = obj['LastModified'].timestamp()
+        return [(key, sizes[key], last_used.get(key, 0.0)) for key in sizes]
+
+    def delete(self, key):
+        for obj in list(self._list(f'{self.prefix}{key}/')):
+            self.s3_client.delete_object(Bucket=self.bucket, Key=obj['Key'])
+
+
+class ResultCache:
+    """Content-addressed store of stage outputs with least-recently-used eviction
+    once the total size or entry count exceeds its bounds."""
+
+    def __init__(self, backend, max_bytes=5 * 1024 ** 3, max_entries=1000):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+    def lookup(self, key):
+        """Result files {name: bytes} for key, or None on a miss"""
+        return self.backend.get(key)
+
+    def store(self, key, files):
+        self.backend.put(key, files)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Drop least recently used entries until within max_bytes and max_entries"""
+        entries = sorted(self.backend.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes and count <= self.max_entries:
+                break
+            if key == keep:
+                continue
+            self.backend.delete(key)
+            total -= size
+            count -= 1
@@ -0,0 +1,121 @@
+import numpy as np
+from math import ceil, floor, log
+
+
+class RiskAccumulator:
+    """Mergeable online risk statistics for a set of portfolios.
+
+    Moments use Chan/Welford pairwise updates. Quantiles come from a
+    log-bucketed sketch over gross returns (1 + r) with fixed relative
+    accuracy, so accumulators built on separate chunks or workers merge
+    exactly by adding bucket counts. The sketch is n_buckets int64 counts per
+    portfolio (1845 at the default accuracy and range), so memory is
+    independent of the number of simulations but linear in n_portfolios.
+    """
+
+    def __init__(self, n_portfolios, relative_accuracy=0.005, min_value=1e-4, max_value=1e4):
+        self.n_portfolios = n_portfolios
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.bucket_offset = floor(log(min_value) / self.log_gamma)
+        self.n_buckets = ceil(log(max_value) / self.log_gamma) - self.bucket_offset + 1
+
+        self.count = 0
+        self.mean = np.zeros(n_portfolios)
+        self.m2 = np.zeros(n_portfolios)
+        self.losses = np.zeros(n_portfolios, dtype=np.int64)
+        self.bucket_counts = np.zeros((n_portfolios, self.n_buckets), dtype=np.int64)
+
+    def update(self, simulated_returns):
+        """Fold a (n_sims, n_portfolios) or (n_sims,) block of simulated returns into the state"""
+        block = np.asarray(simulated_returns, dtype=float).reshape(len(simulated_returns), -1)
+        n = len(block)
+        if n == 0:
+            return self
+
+        block_mean = block.mean(axis=0)
+        block_m2 = ((block - block_mean) ** 2).sum(axis=0)
+        self._merge_moments(n, block_mean, block_m2)
+        self.losses += (block < 0).sum(axis=0)
+
+        gross = np.clip(1.0 + block, self.min_value, self.max_value)
+        idx = np.ceil(np.log(gross) / self.log_gamma).astype(np.int64) - self.bucket_offset
+        np.clip(idx, 0, self.n_buckets - 1, out=idx)
+        # Offset each portfolio's buckets so a single bincount fills the whole table
+        idx += np.arange(self.n_portfolios) * self.n_buckets
+        self.bucket_counts += np.bincount(idx.ravel(), minlength=self.bucket_counts.size).reshape(self.bucket_counts.shape)
+        return self
+
+    def merge(self, other):
+        """Combine another accumulator built with the same sketch parameters"""
+        if (other.n_portfolios, other.n_buckets, other.bucket_offset) != (self.n_portfolios, self.n_buckets, self.bucket_offset):
+            raise ValueError("Cannot merge accumulators with different portfolio counts or sketch parameters")
+        if other.count:
+            self._merge_moments(other.count, other.mean, other.m2)
+            self.losses += other.losses
+            self.bucket_counts += other.bucket_counts
+        return self
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+
+    def _bucket_returns(self):
+        indices = np.arange(self.n_buckets) + self.bucket_offset
+        # Midpoint of (gamma^(i-1), gamma^i] in the relative-error sense
+        return 2 * self.gamma ** indices / (self.gamma + 1) - 1.0
+
+    def variance(self):
+        return self.m2 / self.count if self.count else np.full(self.n_portfolios, np.nan)
+
+    def quantile(self, q):
+        """Approximate q-quantile of returns per portfolio"""
+        cumulative = np.cumsum(self.bucket_counts, axis=1)
+        rank = q * (self.count - 1)
+        return self._bucket_returns()[(cumulative > rank).argmax(axis=1)]
+
+    def tail_mean(self, q):
+        """Approximate mean of the lowest q fraction of returns (CVaR) per portfolio"""
+        values = self._bucket_returns()
+        target = q * self.count
+        cumulative = np.cumsum(self.bucket_counts, axis=1)
+        weighted = np.cumsum(self.bucket_counts * values, axis=1)
+        k = (cumulative >= target).argmax(axis=1)
+        rows = np.arange(self.n_portfolios)
+        count_before = np.where(k > 0, cumulative[rows, k - 1], 0)
+        sum_before = np.where(k > 0, weighted[rows, k - 1], 0.0)
+        return (sum_before + (target - count_before) * values[k]) / target
+
+    def cdf(self, x):
+        """Approximate fraction of returns below x (scalar or per-portfolio array)"""
+        below = self._bucket_returns() < np.reshape(x, (-1, 1))
+        return (self.bucket_counts * below).sum(axis=1) / self.count
+
+    def statistics(self, tail=0.05, shift=None):
+        """(expected_returns, volatility, prob_loss, VaR, CVaR) arrays over portfolios
+
+        ``shift`` translates every portfolio's return distribution, e.g. for a
+        control-variate correction of the mean; the loss probability then
+        comes from the sketch instead of the exact loss counts.
+        """
+        if shift is None:
+            return (
+                self.mean.copy(),
+                np.sqrt(self.variance()),
+                self.losses / self.count,
+                self.quantile(tail),
+                self.tail_mean(tail),
+            )
+        return (
+            self.mean + shift,
+            np.sqrt(self.variance()),
+            self.cdf(-shift),
+            self.quantile(tail) + shift,
+            self.tail_mean(tail) + shift,
+        )
@@ -1,8 +1,10 @@
 import boto3
-import pandas as pd
-from io import StringIO
+from botocore.config import Config
+import numpy as np
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO, BytesIO
 import json
-import ast
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 from math import exp
 from datetime import datetime
@@ -15,6 +17,12 @@ risk_free_rate = 0.01      # Risk-free rate for Sharpe Ratio (e.g., 1%)
 num_portfolios = 1      # Number of different portfolio weight combinations to test
 num_days = 252
 run_date = datetime.now().strftime('%Y-%m-%d')
+max_fetch_workers = 32     # Concurrent shard downloads; also sizes the S3 connection pool
+# Optional frontier queries answered from the frontier index (the event can override)
+max_volatility = None      # Highest-return frontier portfolio with volatility <= this
+target_return = None       # Lowest-volatility frontier portfolio returning >= this
+# Created at init so warm invocations reuse the client and its connection pool
+s3_client = boto3.client('s3', config=Config(max_pool_connections=max_fetch_workers))
 
 def write_opt_metadata_to_dynamodb(table_name, run_date, initial_portfolio_value, 
                                     min_vol_id, min_volatility, min_vol_returns, vol_ev, vol_weights,
@@ -51,44 +59,155 @@ def write_opt_metadata_to_dynamodb(table_name, run_date, initial_portfolio_value
         print(f"Error writing to DynamoDB: {str(e)}")
         raise 
 
+def read_results_from_s3(s3_client, bucket, key, columns=None):
+    """Load an .npz results file; only the requested columns are decompressed into arrays"""
+    obj = s3_client.get_object(Bucket=bucket, Key=key)
+    with np.load(BytesIO(obj['Body'].read()), allow_pickle=False) as results:
+        metadata = json.loads(str(results['__metadata__']))
+        names = [name for name in results.files if name != '__metadata__'] if columns is None else columns
+        return {name: results[name] for name in names}, metadata
+
+def list_result_shards(s3_client, bucket, prefix, name='sim_results'):
+    """Discover every Batch array job's {name}_<i>.npz file under prefix, ordered by job index"""
+    shard_pattern = re.compile(rf'{name}_(\d+)\.npz$')
+    shards = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}{name}_'):
+        for obj in page.get('Contents', []):
+            match = shard_pattern.search(obj['Key'])
+            if match:
+                shards.append((int(match.group(1)), obj['Key']))
+    return [key for _, key in sorted(shards)]
+
+def shard_job_index(key):
+    return int(re.search(r'_(\d+)\.npz$', key).group(1))
+
+def select_run(shards, keys, run_id=None, array_size=None):
+    """Shards (and their keys) of one Batch array run.
+
+    With run_id, shards stamped with another run are dropped; without it, shards
+    from more than one run are an error. With array_size, every job index
+    0..array_size-1 must be present exactly once.
+    """
+    if run_id is not None:
+        kept = [(shard, key) for shard, key in zip(shards, keys) if shard[1].get('run_id') == run_id]
+        if len(kept) < len(shards):
+            print(f"Ignored {len(shards) - len(kept)} shards from other runs")
+        shards, keys = [shard for shard, _ in kept], [key for _, key in kept]
+    else:
+        run_ids = {shard_metadata.get('run_id') for _, shard_metadata in shards}
+        if len(run_ids) > 1:
+            raise ValueError(f"Result shards come from {len(run_ids)} different runs; "
+                             "pass run_id or array_size in the event")
+    if array_size is not None:
+        job_indices = sorted(shard_metadata['job_index'] for _, shard_metadata in shards)
+        if job_indices != list(range(array_size)):
+            raise ValueError(f"Expected shards for jobs 0..{array_size - 1}, found {job_indices}")
+    if not shards:
+        raise ValueError(f"No result shards for run {run_id}")
+    return shards, keys
+
+def fetch_shards(s3_client, bucket, keys):
+    """Download shards concurrently over the shared client, preserving key order"""
+    with ThreadPoolExecutor(max_workers=max(1, min(max_fetch_workers, len(keys)))) as executor:
+        return list(executor.map(lambda key: read_results_from_s3(s3_client, bucket, key), keys))
+
+# pareto_front_indices and summarize_results must stay identical to the copies in
+# aws_batch/monte-carlo-sim.py: merging is exact only if jobs and combiner agree
+def pareto_front_indices(volatility, returns):
+    """Indices of portfolios no other portfolio beats on both lower volatility and higher return"""
+    candidates = np.flatnonzero(np.isfinite(volatility) & np.isfinite(returns))
+    # Volatility ascending, ties broken by return descending
+    order = candidates[np.lexsort((-returns[candidates], volatility[candidates]))]
+    best_before = np.maximum.accumulate(np.concatenate([[-np.inf], returns[order][:-1]]))
+    return order[returns[order] > best_before]
+
+def summarize_results(columns, top_k):
+    """Top-k rows by Sharpe, bottom-k by volatility and the Pareto frontier (as in the Batch job)"""
+    sharpe = np.where(np.isnan(columns['sharpe_ratio']), -np.inf, columns['sharpe_ratio'])
+    volatility = np.where(np.isnan(columns['volatility']), np.inf, columns['volatility'])
+    k = min(top_k, len(sharpe))
+    top_sharpe = np.argpartition(-sharpe, k - 1)[:k] if k else []
+    low_volatility = np.argpartition(volatility, k - 1)[:k] if k else []
+    frontier = pareto_front_indices(columns['volatility'], columns['returns'])
+    keep = np.unique(np.concatenate([top_sharpe, low_volatility, frontier]).astype(np.int64))
+    return {name: column[keep] for name, column in columns.items()}
+
+def max_return_for_volatility(frontier, max_volatility):
+    """Row of the highest-return frontier portfolio with volatility <= max_volatility, or None.
+    The frontier is volatility ascending, so returns ascend too and one binary search answers it"""
+    idx = int(np.searchsorted(frontier['volatility'], max_volatility, side='right')) - 1
+    return None if idx < 0 else idx
+
+def min_volatility_for_return(frontier, target_return):
+    """Row of the lowest-volatility frontier portfolio returning at least target_return, or None"""
+    idx = int(np.searchsorted(frontier['returns'], target_return, side='left'))
+    return None if idx >= len(frontier['returns']) else idx
+
+def frontier_query_item(frontier, idx, asset_names):
+    return {
+        'SimulationID': str(frontier['simulation_id'][idx]),
+        'Returns': Decimal(str(frontier['returns'][idx])),
+        'Volatility': Decimal(str(frontier['volatility'][idx])),
+        'Sharpe': Decimal(str(frontier['sharpe_ratio'][idx])),
+        'Weights': {asset: Decimal(str(frontier[f'weight_{asset}'][idx])) for asset in asset_names},
+    }
+
+def merge_summaries(summaries):
+    """Pairwise tree reduction of per-job partial aggregates into one global summary"""
+    while len(summaries) > 1:
+        merged = []
+        for i in range(0, len(summaries), 2):
+            pair = summaries[i:i + 2]
+            columns = {name: np.concatenate([c[name] for c, _ in pair]) for name in pair[0][0]}
+            metadata = dict(pair[0][1], num_portfolios=sum(m['num_portfolios'] for _, m in pair))
+            merged.append((summarize_results(columns, metadata['top_k']), metadata))
+        summaries = merged
+    return summaries[0]
+
+def write_results_to_s3(s3_client, bucket, key, columns, metadata):
+    local_file = '/tmp/' + key.rsplit('/', 1)[-1]
+    np.savez(local_file, __metadata__=np.array(json.dumps(metadata)), **columns)
+    s3_client.upload_file(local_file, bucket, key)
+
 def lambda_handler(event, context):
-    s3_client = boto3.client('s3')
     bucket = 'monte-carlo-raw-data-william-chang'
     prefix = 'processed_data/'
 
-    combined_df = pd.DataFrame()
+    event = event or {}
+    # Step Functions passes the array job's id and size; either one pins the run
+    run_id, array_size = event.get('run_id'), event.get('array_size')
 
     try:
-        for i in range(10):
-            key = f'{prefix}sim_results_{i}.csv'
-            obj = s3_client.get_object(Bucket=bucket, Key=key)
-            df = pd.read_csv(obj['Body'])
-            combined_df = pd.concat([combined_df, df], ignore_index=True)
-        
-        results_df = pd.DataFrame(combined_df)
-        # Parse the 'weights' column from Python-style strings to dictionaries
-        results_df['weights'] = results_df['weights'].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-
-        max_sharpe_idx = results_df['sharpe_ratio'].idxmax()
-        min_volatility_idx = results_df['volatility'].idxmin()
-    
-        max_sharpe_row = results_df.loc[max_sharpe_idx]
-        min_vol_row = results_df.loc[min_volatility_idx]
-
-        max_sharpe_id = max_sharpe_row['simulation_id']
-        min_vol_id = min_vol_row['simulation_id']
-
-        max_sharpe = max_sharpe_row['sharpe_ratio']
-        min_vol = min_vol_row['volatility']
-
-        max_sharpe_weights = max_sharpe_row['weights']
-        min_vol_weights = min_vol_row['weights']
-        
-        if not isinstance(max_sharpe_weights, dict) or not isinstance(min_vol_weights, dict):
-            raise ValueError(f"Weights are not in dictionary format after parsing: max_sharpe_weights={max_sharpe_weights}, min_vol_weights={min_vol_weights}")
-
-        max_sharpe_returns = max_sharpe_row['returns']
-        min_vol_returns = min_vol_row['returns']
+        summary_keys = list_result_shards(s3_client, bucket, prefix, 'sim_summary')
+        if array_size is not None:
+            summary_keys = [key for key in summary_keys if shard_job_index(key) < array_size]
+        if not summary_keys:
+            raise ValueError(f"No simulation summaries found under s3://{bucket}/{prefix}")
+        summaries, summary_keys = select_run(fetch_shards(s3_client, bucket, summary_keys), summary_keys,
+                                             run_id, array_size)
+        print(f"Fetched {len(summaries)} summary shards")
+        asset_names = summaries[0][1]['asset_names']
+        if any(shard_metadata['asset_names'] != asset_names for _, shard_metadata in summaries):
+            raise ValueError("Result shards were simulated over different asset universes")
+        # The optima are always inside the merged top-k / frontier rows, so full
+        # results are only touched when a combined detail file is requested
+        summary, metadata = merge_summaries(summaries)
+
+        max_sharpe_idx = int(np.nanargmax(summary['sharpe_ratio']))
+        min_volatility_idx = int(np.nanargmin(summary['volatility']))
+
+        max_sharpe_id = str(summary['simulation_id'][max_sharpe_idx])
+        min_vol_id = str(summary['simulation_id'][min_volatility_idx])
+
+        max_sharpe = float(summary['sharpe_ratio'][max_sharpe_idx])
+        min_vol = float(summary['volatility'][min_volatility_idx])
+
+        max_sharpe_weights = {asset: float(summary[f'weight_{asset}'][max_sharpe_idx]) for asset in asset_names}
+        min_vol_weights = {asset: float(summary[f'weight_{asset}'][min_volatility_idx]) for asset in asset_names}
+
+        max_sharpe_returns = float(summary['returns'][max_sharpe_idx])
+        min_vol_returns = float(summary['returns'][min_volatility_idx])
 
         expected_max_sharpe_value = initial_portfolio_value * exp(max_sharpe_returns)
         expected_min_volatility_value = initial_portfolio_value * exp(min_vol_returns)
@@ -100,8 +219,44 @@ def lambda_handler(event, context):
             num_days, "Completed"
         ) 
 
-        combined_df.to_csv('/tmp/sim_results_combined.csv', index=False)
-        s3_client.upload_file('/tmp/sim_results_combined.csv', bucket, f'{prefix}sim_results_combined.csv')
+        combined_metadata = {k: v for k, v in metadata.items() if k != 'job_index'}
+        combined_metadata['num_shards'] = len(summaries)
+        # Full results hold every row and scale with the run; the summary does not.
+        # Recorded so visualize_results never plots a combined file from another run
+        combine_full_results = bool(event.get('combine_full_results', False))
+        combined_metadata['full_results'] = combine_full_results
+        job_indices = {shard_job_index(key) for key in summary_keys}
+        write_results_to_s3(s3_client, bucket, f'{prefix}sim_summary_combined.npz', summary, combined_metadata)
+        # Exact efficient frontier, volatility ascending (and so returns ascending)
+        frontier = pareto_front_indices(summary['volatility'], summary['returns'])
+        frontier_columns = {name: column[frontier] for name, column in summary.items()}
+        write_results_to_s3(s3_client, bucket, f'{prefix}efficient_frontier.npz', frontier_columns, combined_metadata)
+
+        # Risk-budget and return-target portfolios, straight from the frontier index
+        queries = {}
+        volatility_budget = event.get('max_volatility', max_volatility)
+        if volatility_budget is not None:
+            idx = max_return_for_volatility(frontier_columns, volatility_budget)
+            if idx is not None:
+                queries['MaxReturnForVolatility'] = dict(frontier_query_item(frontier_columns, idx, asset_names),
+                                                         MaxVolatility=Decimal(str(volatility_budget)))
+        return_target = event.get('target_return', target_return)
+        if return_target is not None:
+            idx = min_volatility_for_return(frontier_columns, return_target)
+            if idx is not None:
+                queries['MinVolatilityForReturn'] = dict(frontier_query_item(frontier_columns, idx, asset_names),
+                                                         TargetReturn=Decimal(str(return_target)))
+        if queries:
+            print(f"Frontier queries answered: {', '.join(queries)}")
+            dynamodb.Table(opt_dynamodb_table).put_item(Item={
+                'SimulationID': "Frontier_Queries", 'RunDate': run_date, 'TimeHorizon': int(num_days), **queries})
+
+        if combine_full_results:
+            result_keys = [key for key in list_result_shards(s3_client, bucket, prefix) if shard_job_index(key) in job_indices]
+            shards, _ = select_run(fetch_shards(s3_client, bucket, result_keys), result_keys,
+                                   metadata.get('run_id'), len(job_indices) if array_size is not None else None)
+            full_results = {name: np.concatenate([columns[name] for columns, _ in shards]) for name in shards[0][0]}
+            write_results_to_s3(s3_client, bucket, f'{prefix}sim_results_combined.npz', full_results, combined_metadata)
 
         return {
             'statusCode': 200,
@@ -1,35 +1,144 @@
 import json
-import yfinance as yf
 import pandas as pd
+import numpy as np
 import boto3
-from datetime import datetime
+from botocore.exceptions import ClientError
+from io import BytesIO
+from datetime import datetime, timedelta
+
+# Per-ticker close history: s3://{bucket}/{price_store_prefix}{ticker}.npz holding
+# 'dates' (datetime64[D]) and 'close' (float64), sorted by date
+price_store_prefix = 'price_store/'
+# yfinance closes are split- (and by default dividend-) adjusted, so a corporate
+# action rescales the whole history. Each incremental download re-fetches the last
+# stored date; a close that moved by more than this relative tolerance means the
+# ticker's full window is downloaded again instead of appended to
+adjustment_tolerance = 1e-5
+# Created at init so warm invocations reuse the client and its connections
+s3_client = boto3.client('s3')
+
+def extract_close(data, tickers):
+    """Close prices with one column per ticker from a yfinance download"""
+    if isinstance(data.columns, pd.MultiIndex):
+        close_data = data['Close']
+        print("Extracted 'Close' data as adjusted closing prices.")
+    elif 'Close' in data.columns and len(tickers) == 1:
+        close_data = data[['Close']].rename(columns={'Close': tickers[0]})
+    else:
+        close_data = data
+        print("DataFrame does not have multi-level index. Using as-is.")
+    return close_data
+
+def load_ticker_history(s3_client, bucket, ticker):
+    """Stored (dates, close) arrays for a ticker, or None if it has never been fetched"""
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=f'{price_store_prefix}{ticker}.npz')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    with np.load(BytesIO(obj['Body'].read()), allow_pickle=False) as history:
+        return history['dates'], history['close']
+
+def save_ticker_history(s3_client, bucket, ticker, dates, close):
+    buffer = BytesIO()
+    np.savez(buffer, dates=dates, close=close)
+    buffer.seek(0)
+    s3_client.upload_fileobj(buffer, bucket, f'{price_store_prefix}{ticker}.npz')
+
+def merge_history(history, new_close):
+    """Merge downloaded closes into stored history; re-fetched dates take the new value"""
+    new_close = new_close.dropna()
+    new_dates = new_close.index.values.astype('datetime64[D]')
+    if history is None:
+        return new_dates, new_close.values.astype(float)
+    dates = np.concatenate([history[0], new_dates])
+    close = np.concatenate([history[1], new_close.values.astype(float)])
+    # Keep the last occurrence of each date so repeated runs are idempotent
+    _, last = np.unique(dates[::-1], return_index=True)
+    keep = len(dates) - 1 - last
+    return dates[keep], close[keep]
+
+def history_adjusted(history, new_close):
+    """True if the download's close on the last stored date differs from the stored one,
+    i.e. a split or dividend after that date re-adjusted the whole series"""
+    last_date = pd.Timestamp(history[0][-1])
+    if last_date not in new_close.index or pd.isna(new_close[last_date]):
+        return False
+    return not np.isclose(new_close[last_date], history[1][-1], rtol=adjustment_tolerance, atol=0.0)
+
+def update_price_store(s3_client, bucket, assets, start_date, end_date, download=None):
+    """Bring every ticker's stored history up to end_date (exclusive), downloading only
+    the trailing dates (from the last stored one) for known tickers and the full window
+    for new or re-adjusted ones.
+    ``download`` defaults to yf.download and can be swapped for a local stand-in."""
+    histories = {ticker: load_ticker_history(s3_client, bucket, ticker) for ticker in assets}
+
+    # Tickers that need the same window share one download
+    windows = {}
+    for ticker, history in histories.items():
+        if history is None:
+            windows.setdefault(start_date, []).append(ticker)
+            continue
+        last_date = pd.Timestamp(history[0][-1])
+        # Only when there are new dates; the last stored one is the adjustment check
+        if (last_date + timedelta(days=1)).strftime('%Y-%m-%d') < end_date:
+            windows.setdefault(last_date.strftime('%Y-%m-%d'), []).append(ticker)
+
+    if windows and download is None:
+        # yfinance is only imported when something actually needs downloading
+        import yfinance as yf
+        download = yf.download
+
+    def fetch(fetch_start, tickers):
+        print(f"Downloading {tickers} from {fetch_start} to {end_date}")
+        data = download(tickers, start=fetch_start, end=end_date)
+        if data is None or data.empty:
+            return {}
+        close_data = extract_close(data, tickers)
+        return {ticker: close_data[ticker].dropna() for ticker in tickers if ticker in close_data.columns}
+
+    readjusted = []
+    for fetch_start, tickers in windows.items():
+        for ticker, new_close in fetch(fetch_start, tickers).items():
+            if histories[ticker] is not None and history_adjusted(histories[ticker], new_close):
+                readjusted.append(ticker)
+                continue
+            histories[ticker] = merge_history(histories[ticker], new_close)
+            save_ticker_history(s3_client, bucket, ticker, *histories[ticker])
+    if readjusted:
+        print(f"Stored closes of {readjusted} were re-adjusted (split or dividend); replacing their history")
+        for ticker, new_close in fetch(start_date, readjusted).items():
+            histories[ticker] = merge_history(None, new_close)
+            save_ticker_history(s3_client, bucket, ticker, *histories[ticker])
+
+    series = {
+        ticker: pd.Series(history[1], index=pd.DatetimeIndex(history[0], name='Date'))
+        for ticker, history in histories.items() if history is not None
+    }
+    close_data = pd.DataFrame(series)
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    return close_data[(close_data.index >= start) & (close_data.index < end)]
 
 def lambda_handler(event, context):
     assets = ['META', 'GM', 'NVDA', 'JPM', 'GAP', 'GLD', 'PLTR', 'SPY']
     start_date = '2020-01-01'
-    end_date = '2025-05-23'
+    end_date = (event or {}).get('end_date', datetime.now().strftime('%Y-%m-%d'))
     s3_bucket = "monte-carlo-raw-data-william-chang"
     s3_key = f"raw_data/{datetime.now().strftime('%Y%m%d')}.csv"
-    s3_client = boto3.client('s3')
 
     try:
-        data = yf.download(assets, start=start_date, end=end_date)
-        if isinstance(data.columns, pd.MultiIndex):
-            close_data = data['Close']
-            print("Extracted 'Close' data as adjusted closing prices.")
-        else:
-            close_data = data
-            print("DataFrame does not have multi-level index. Using as-is.")
+        close_data = update_price_store(s3_client, s3_bucket, assets, start_date, end_date)
 
         if close_data.empty:
             raise ValueError("No data downloaded.")
-        
+
         local_file = '/tmp/portfolio_data.csv'
-        close_data.to_csv(local_file)
+        close_data.sort_index(axis=1).to_csv(local_file)
         s3_client.upload_file(local_file, s3_bucket, s3_key)
         print(f"Data uploaded to S3: s3://{s3_bucket}/{s3_key}")
         return {'statusCode': 200, 'body': json.dumps(f"Data uploaded to s3://{s3_bucket}/{s3_key}")}
     except Exception as e:
         error_msg = f"Error occurred: {str(e)}"
         print(error_msg)
-        return {'statusCode': 500, 'body': json.dumps(error_msg)}
\ No newline at end of file
+        return {'statusCode': 500, 'body': json.dumps(error_msg)}
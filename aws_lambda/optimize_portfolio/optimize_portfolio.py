@@ -0,0 +1,260 @@
+import json
+import numpy as np
+import boto3
+from botocore.exceptions import ClientError
+from decimal import Decimal
+from io import BytesIO
+from datetime import datetime
+
+# Solves directly for the optimal long-only allocations instead of searching
+# random Dirichlet weights. Moments are those of the simulated terminal returns,
+# so returns / volatility / Sharpe match what the Batch job reports
+bucket = 'monte-carlo-raw-data-william-chang'
+covariance_key = 'processed_data/covariance.npz'
+optimized_key = 'processed_data/optimized_portfolios.npz'
+opt_dynamodb_table = "OptimalPortfolios"
+initial_portfolio_value = 100000
+risk_free_rate = 0.01
+num_days = 252
+T = 1
+num_frontier_points = 50    # Target returns on the efficient frontier
+num_scenarios = 10000       # Terminal return scenarios for the CVaR linear program
+cvar_tail = 0.05
+scenario_seed = 0
+tolerance = 1e-12
+max_iterations = 1000       # Active-set changes before giving up
+# Created at init so warm invocations reuse the clients and their connections
+s3_client = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+
+def terminal_moments(mean_returns, covariance, horizon=T):
+    """Exact mean and covariance of simple terminal returns S_T / S_0 - 1 under GBM"""
+    growth = np.exp(np.asarray(mean_returns, dtype=float) * horizon)
+    return growth - 1.0, np.outer(growth, growth) * np.expm1(np.asarray(covariance, dtype=float) * horizon)
+
+def terminal_scenarios(mean_returns, covariance, n, seed=scenario_seed, horizon=T, factors=None):
+    """(n, n_assets) simple terminal returns drawn from the GBM terminal distribution in one step.
+
+    With factors=(loadings, idiosyncratic_var) the shocks come from the factor
+    model, as a singular covariance (n_assets >= n_days) has no Cholesky factor.
+    """
+    covariance = np.asarray(covariance, dtype=float)
+    drift = (np.asarray(mean_returns, dtype=float) - 0.5 * np.diag(covariance)) * horizon
+    rng = np.random.default_rng(seed)
+    if factors is None:
+        chol = np.linalg.cholesky(covariance * horizon)
+        shocks = rng.standard_normal((n, len(drift))) @ chol.T
+    else:
+        loadings, idiosyncratic_var = factors
+        rand = rng.standard_normal((n, loadings.shape[1] + len(drift)))
+        shocks = (rand[:, :loadings.shape[1]] @ loadings.T
+                  + rand[:, loadings.shape[1]:] * np.sqrt(idiosyncratic_var)) * np.sqrt(horizon)
+    return np.expm1(drift + shocks)
+
+def active_set_qp(hessian, constraints, targets, start):
+    """min 1/2 w' H w subject to A w = b and w >= 0, by a primal active-set method.
+
+    ``start`` must be feasible. Each iteration solves the equality-constrained
+    step on the free variables; blocked steps fix a variable at zero and a
+    negative bound multiplier frees one, so the result is an exact optimum.
+    Raises RuntimeError if that optimum is not reached within max_iterations.
+    """
+    constraints = np.atleast_2d(constraints)
+    num_constraints = len(constraints)
+    w = np.where(start > tolerance, start, 0.0)
+    free = w > 0
+    for _ in range(max_iterations):
+        index = np.flatnonzero(free)
+        gradient = hessian @ w
+        kkt = np.zeros((len(index) + num_constraints,) * 2)
+        kkt[:len(index), :len(index)] = hessian[np.ix_(index, index)]
+        kkt[:len(index), len(index):] = constraints[:, index].T
+        kkt[len(index):, :len(index)] = constraints[:, index]
+        rhs = np.concatenate([-gradient[index], np.zeros(num_constraints)])
+        solution = np.linalg.lstsq(kkt, rhs, rcond=None)[0]
+        step, multipliers = solution[:len(index)], solution[len(index):]
+
+        if np.max(np.abs(step), initial=0.0) < tolerance:
+            bound_multipliers = gradient + constraints.T @ multipliers
+            bound_multipliers[free] = np.inf
+            release = np.argmin(bound_multipliers)
+            if bound_multipliers[release] >= -tolerance:
+                return np.maximum(w, 0.0)
+            free[release] = True
+            continue
+
+        # Longest step along the direction that keeps every free variable non-negative
+        shrinking = step < 0
+        ratios = np.full(len(index), np.inf)
+        ratios[shrinking] = -w[index][shrinking] / step[shrinking]
+        blocking = np.argmin(ratios)
+        alpha = min(1.0, ratios[blocking])
+        w[index] += alpha * step
+        if alpha < 1.0:
+            w[index[blocking]] = 0.0
+            free[index[blocking]] = False
+    raise RuntimeError(f"Active-set QP did not converge in {max_iterations} iterations")
+
+def min_variance_weights(sigma):
+    n = len(sigma)
+    return active_set_qp(2 * sigma, np.ones(n), [1.0], np.full(n, 1.0 / n))
+
+def frontier_weights(mu, sigma, target, start):
+    """Minimum-variance simplex portfolio returning exactly target (mu' start <= target <= max(mu))"""
+    best = np.eye(len(mu))[np.argmax(mu)]
+    if target >= mu.max():
+        return best
+    # Feasible warm start: mix the previous point with the highest-return asset
+    theta = max(0.0, (target - mu @ start) / (mu.max() - mu @ start))
+    w = (1 - theta) * start + theta * best
+    return active_set_qp(2 * sigma, np.vstack([np.ones(len(mu)), mu]), [1.0, target], w)
+
+def max_sharpe_weights(mu, sigma, rf=risk_free_rate):
+    """Tangency portfolio: y = argmin y' sigma y s.t. (mu - rf)' y = 1, y >= 0, then w = y / sum(y).
+
+    Returns None when no asset beats the risk-free rate.
+    """
+    excess = mu - rf
+    best = np.argmax(excess)
+    if excess[best] <= 0:
+        return None
+    start = np.zeros(len(mu))
+    start[best] = 1.0 / excess[best]
+    y = active_set_qp(2 * sigma, excess, [1.0], start)
+    return y / y.sum()
+
+def min_cvar_weights(scenarios, tail=cvar_tail):
+    """Rockafellar-Uryasev linear program: minimize the mean of the worst tail of
+    scenario losses over the simplex. Returns (weights, CVaR as a return)."""
+    from scipy.optimize import linprog
+    from scipy import sparse
+
+    n_scenarios, n_assets = scenarios.shape
+    # Variables: [w (n_assets), var (1), excess losses u (n_scenarios)]
+    cost = np.concatenate([np.zeros(n_assets), [1.0], np.full(n_scenarios, 1.0 / (tail * n_scenarios))])
+    # -r_s' w - var - u_s <= 0
+    a_ub = sparse.hstack([
+        sparse.csr_matrix(-scenarios),
+        sparse.csr_matrix(-np.ones((n_scenarios, 1))),
+        -sparse.identity(n_scenarios, format='csr'),
+    ], format='csr')
+    a_eq = np.concatenate([np.ones(n_assets), [0.0], np.zeros(n_scenarios)])[None, :]
+    bounds = [(0, None)] * n_assets + [(None, None)] + [(0, None)] * n_scenarios
+    result = linprog(cost, A_ub=a_ub, b_ub=np.zeros(n_scenarios), A_eq=a_eq, b_eq=[1.0],
+                     bounds=bounds, method='highs')
+    if not result.success:
+        raise ValueError(f"CVaR optimization failed: {result.message}")
+    weights = np.maximum(result.x[:n_assets], 0.0)
+    return weights / weights.sum(), -result.fun
+
+def scenario_cvar(scenario_returns, tail=cvar_tail):
+    """Mean of the lowest tail fraction of returns, as the LP defines it"""
+    k = tail * len(scenario_returns)
+    ordered = np.sort(scenario_returns)
+    whole = int(np.floor(k))
+    partial = ordered[whole] * (k - whole) if whole < len(ordered) else 0.0
+    return (ordered[:whole].sum() + partial) / k
+
+def optimize(mean_returns, covariance, num_points=num_frontier_points, scenarios=None):
+    """Named optima plus the efficient frontier as parallel lists of (label, weights)"""
+    mu, sigma = terminal_moments(mean_returns, covariance)
+    min_variance = min_variance_weights(sigma)
+    frontier, w = [], min_variance
+    for target in np.linspace(mu @ min_variance, mu.max(), num_points):
+        w = frontier_weights(mu, sigma, target, w)
+        frontier.append(w)
+
+    max_sharpe = max_sharpe_weights(mu, sigma)
+    if max_sharpe is None:
+        sharpe = [(mu @ w - risk_free_rate) / np.sqrt(w @ sigma @ w) for w in frontier]
+        max_sharpe = frontier[int(np.argmax(sharpe))]
+    portfolios = [('min_variance', min_variance), ('max_sharpe', max_sharpe)]
+    if scenarios is not None:
+        portfolios.append(('min_cvar', min_cvar_weights(scenarios)[0]))
+    portfolios += [(f'frontier_{i}', w) for i, w in enumerate(frontier)]
+    return portfolios, mu, sigma
+
+def read_npz_from_s3(s3_client, bucket, key):
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    with np.load(BytesIO(obj['Body'].read()), allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+def write_results_to_s3(s3_client, bucket, key, columns, metadata):
+    buffer = BytesIO()
+    np.savez(buffer, __metadata__=np.array(json.dumps(metadata)), **columns)
+    buffer.seek(0)
+    s3_client.upload_fileobj(buffer, bucket, key)
+
+def lambda_handler(event, context):
+    run_date = datetime.now().strftime('%Y-%m-%d')
+
+    try:
+        covariance = read_npz_from_s3(s3_client, bucket, covariance_key)
+        if covariance is None:
+            raise ValueError(f"No covariance artifact at s3://{bucket}/{covariance_key}")
+        asset_names = [str(name) for name in covariance['asset_names']]
+        # The statistics stage omits the Cholesky factor when the covariance is singular
+        factors = None if 'cholesky' in covariance else (covariance['factor_loadings'], covariance['idiosyncratic_var'])
+        scenarios = terminal_scenarios(covariance['mean_returns'], covariance['covariance'], num_scenarios,
+                                       factors=factors)
+
+        portfolios, mu, sigma = optimize(covariance['mean_returns'], covariance['covariance'], scenarios=scenarios)
+        labels = [label for label, _ in portfolios]
+        weights_matrix = np.array([w for _, w in portfolios])
+        returns = weights_matrix @ mu
+        volatility = np.sqrt(np.einsum('ij,jk,ik->i', weights_matrix, sigma, weights_matrix))
+        sharpe = (returns - risk_free_rate) / volatility
+        cvar_95 = np.array([scenario_cvar(scenarios @ w) for w in weights_matrix])
+        print(f"Solved {len(labels)} portfolios over {len(asset_names)} assets")
+
+        columns = {
+            'simulation_id': np.array(labels),
+            'returns': returns,
+            'volatility': volatility,
+            'sharpe_ratio': sharpe,
+            'CVaR_95': cvar_95,
+            **{f'weight_{asset}': weights_matrix[:, i] for i, asset in enumerate(asset_names)},
+        }
+        metadata = {
+            'asset_names': asset_names,
+            'run_date': run_date,
+            'initial_portfolio_value': initial_portfolio_value,
+            'num_days': num_days,
+            'T': T,
+            'risk_free_rate': risk_free_rate,
+            'num_scenarios': num_scenarios,
+            'scenario_seed': scenario_seed,
+        }
+        write_results_to_s3(s3_client, bucket, optimized_key, columns, metadata)
+
+        table = dynamodb.Table(opt_dynamodb_table)
+        item = {'SimulationID': "Optimized_Portfolios", 'RunDate': run_date,
+                'InitialValue': int(initial_portfolio_value), 'TimeHorizon': int(num_days), 'Status': "Completed"}
+        for label in ('min_variance', 'max_sharpe', 'min_cvar'):
+            i = labels.index(label)
+            item[label] = {
+                'Returns': Decimal(str(returns[i])),
+                'Volatility': Decimal(str(volatility[i])),
+                'Sharpe': Decimal(str(sharpe[i])),
+                'CVaR_95': Decimal(str(cvar_95[i])),
+                'ExpectedValue': Decimal(str(initial_portfolio_value * (1 + returns[i]))),
+                'Weights': {asset: Decimal(str(weights_matrix[i, j])) for j, asset in enumerate(asset_names)},
+            }
+        table.put_item(Item=item)
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f"Optimized portfolios uploaded to s3://{bucket}/{optimized_key}")
+        }
+    except Exception as e:
+        error_msg = f"Error occurred: {str(e)}"
+        print(error_msg)
+        return {
+            'statusCode': 500,
+            'body': json.dumps(error_msg)
+        }
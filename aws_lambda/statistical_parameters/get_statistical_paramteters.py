@@ -2,16 +2,210 @@ import json
 import pandas as pd
 import numpy as np
 import boto3
+from botocore.exceptions import ClientError
+from io import BytesIO
 from datetime import datetime
 
+# Covariance engine: sufficient statistics are persisted between runs so a new
+# trading day costs O(n_assets^2) and a new ticker O(n_days * n_assets)
+state_key = 'processed_data/covariance_state.npz'
+covariance_key = 'processed_data/covariance.npz'
+covariance_method = 'sample'  # 'sample' (full history), 'rolling' or 'ewma'
+rolling_window = 252          # Trading days in the rolling covariance window
+ewma_lambda = 0.94            # RiskMetrics decay for the EWMA covariance
+trading_days = 252
+num_factors = 3               # PCA factors in the low-rank covariance model
+# Created at init so warm invocations reuse the client and its connections
+s3_client = boto3.client('s3')
+
+def empty_state(asset_names):
+    n = len(asset_names)
+    return {
+        'asset_names': np.array(asset_names),
+        'last_date': np.array('NaT', dtype='datetime64[D]'),
+        'count': np.array(0),
+        'sums': np.zeros(n),
+        'cross': np.zeros((n, n)),
+        'window_returns': np.zeros((0, n)),
+        'window_sums': np.zeros(n),
+        'window_cross': np.zeros((n, n)),
+        'ewma_count': np.array(0),
+        'ewma_mean': np.zeros(n),
+        'ewma_cov': np.zeros((n, n)),
+    }
+
+def update_state(state, returns):
+    """Fold new daily return rows (n_new, n_assets) into the sufficient statistics"""
+    values = returns.to_numpy(dtype=float)
+    if not len(values):
+        return state
+    state['count'] = state['count'] + len(values)
+    state['sums'] = state['sums'] + values.sum(axis=0)
+    state['cross'] = state['cross'] + values.T @ values
+
+    # Rolling window: add the new days, subtract the ones that fall out
+    window = np.concatenate([state['window_returns'], values])
+    evicted, window = window[:-rolling_window], window[-rolling_window:]
+    state['window_returns'] = window
+    state['window_sums'] = state['window_sums'] + values.sum(axis=0) - evicted.sum(axis=0)
+    state['window_cross'] = state['window_cross'] + values.T @ values - evicted.T @ evicted
+
+    mean, cov = state['ewma_mean'], state['ewma_cov']
+    for i, row in enumerate(values):
+        if state['ewma_count'] + i == 0:
+            mean = row.copy()
+            continue
+        diff = row - mean
+        mean = mean + (1 - ewma_lambda) * diff
+        cov = ewma_lambda * (cov + (1 - ewma_lambda) * np.outer(diff, diff))
+    state['ewma_mean'], state['ewma_cov'] = mean, cov
+    state['ewma_count'] = state['ewma_count'] + len(values)
+
+    state['last_date'] = np.array(returns.index[-1], dtype='datetime64[D]')
+    return state
+
+def reindex_state(state, returns_history):
+    """Match the state to the current ticker list. Dropped tickers are sliced out; new
+    tickers get their cross terms from history in O(n_days * n_assets) without
+    recomputing the existing block. Returns None if a full rebuild is needed."""
+    old_names = list(state['asset_names'])
+    new_names = list(returns_history.columns)
+    if old_names == new_names:
+        return state
+    if not state['count']:
+        return None
+    # Dropped tickers are absent from the history; the kept ones select the covered days
+    kept_names = [name for name in old_names if name in new_names]
+    covered = returns_history.loc[:str(state['last_date'])].dropna(subset=kept_names)
+    added = [name for name in new_names if name not in old_names]
+    # The existing statistics cover a fixed set of days; a new ticker must have all of them
+    if len(covered) != state['count'] or covered[added].isna().any().any():
+        return None
+
+    rebuilt = empty_state(new_names)
+    history = covered[new_names].to_numpy(dtype=float)
+    old_idx = [old_names.index(name) if name in old_names else -1 for name in new_names]
+    new_pos = [i for i, idx in enumerate(old_idx) if idx < 0]
+    kept = np.array([(i, idx) for i, idx in enumerate(old_idx) if idx >= 0])
+    keep_new, keep_old = (kept[:, 0], kept[:, 1]) if len(kept) else ([], [])
+
+    def extend(vector_old, matrix_old, block):
+        """Copy the existing block and fill rows/columns for new tickers from history"""
+        vector = np.zeros(len(new_names))
+        matrix = np.zeros((len(new_names), len(new_names)))
+        vector[keep_new] = vector_old[keep_old]
+        matrix[np.ix_(keep_new, keep_new)] = matrix_old[np.ix_(keep_old, keep_old)]
+        vector[new_pos] = block[:, new_pos].sum(axis=0)
+        cross_new = block.T @ block[:, new_pos]
+        matrix[:, new_pos] = cross_new
+        matrix[new_pos, :] = cross_new.T
+        return vector, matrix
+
+    rebuilt['sums'], rebuilt['cross'] = extend(state['sums'], state['cross'], history)
+    window = history[-len(state['window_returns']):] if len(state['window_returns']) else history[:0]
+    rebuilt['window_sums'], rebuilt['window_cross'] = extend(state['window_sums'], state['window_cross'], window)
+    rebuilt['window_returns'] = window
+    rebuilt['count'] = state['count']
+    rebuilt['last_date'] = state['last_date']
+
+    # EWMA terms involving a new ticker are replayed over history
+    ewma = update_state(empty_state(new_names), covered[new_names])
+    rebuilt['ewma_count'] = ewma['ewma_count']
+    rebuilt['ewma_mean'] = ewma['ewma_mean']
+    rebuilt['ewma_cov'] = ewma['ewma_cov']
+    return rebuilt
+
+def covariance_from_state(state, method=None):
+    """Annualized mean returns, full-history volatility and the chosen annualized covariance"""
+    method = method or covariance_method
+    count = int(state['count'])
+    mean = state['sums'] / count
+    sample_cov = (state['cross'] - count * np.outer(mean, mean)) / (count - 1)
+    if method == 'rolling':
+        n = len(state['window_returns'])
+        window_mean = state['window_sums'] / n
+        cov = (state['window_cross'] - n * np.outer(window_mean, window_mean)) / (n - 1)
+    elif method == 'ewma':
+        cov = state['ewma_cov']
+    else:
+        cov = sample_cov
+    volatility = np.sqrt(np.diag(sample_cov) * trading_days)
+    return mean * trading_days, volatility, cov * trading_days
+
+def factor_window(state, returns_history, method=None):
+    """Daily return rows (m, n_assets) and row weights summing to 1 whose weighted
+    covariance is the chosen covariance method's (approximately for EWMA, whose
+    recursion demeans each day by the previous running mean)"""
+    method = method or covariance_method
+    if method == 'sample':
+        rows = returns_history[list(state['asset_names'])].loc[:str(state['last_date'])].dropna().to_numpy(dtype=float)
+    else:
+        # EWMA weights beyond the rolling window are below 1e-6 of the latest day's
+        rows = state['window_returns']
+    if method == 'ewma':
+        weights = ewma_lambda ** np.arange(len(rows))[::-1]
+    else:
+        weights = np.ones(len(rows))
+    return rows, weights / weights.sum()
+
+def factor_model(returns, weights, variance, k=None, oversample=10, power_iterations=2, seed=0):
+    """PCA factor loadings (n, k) and residual idiosyncratic variances (n,) so that
+    covariance ~ loadings @ loadings.T + diag(idiosyncratic).
+
+    Loadings come from a randomized truncated SVD of the weighted, demeaned daily
+    return window, O(m * n * k) instead of an O(n^3) eigendecomposition of the
+    covariance, and defined even when n_assets >= n_days. ``variance`` is the
+    annualized diagonal of the chosen covariance, which the residual keeps exact.
+    """
+    m, n = returns.shape
+    k = min(k or num_factors, m, n)
+    # Reliability-weight correction: m / (m - 1) for equal weights
+    scale = trading_days / (1.0 - np.sum(weights ** 2))
+    centered = (returns - weights @ returns) * np.sqrt(weights * scale)[:, None]
+    rank = min(k + oversample, m, n)
+    if rank == min(m, n):
+        _, singular_values, vt = np.linalg.svd(centered, full_matrices=False)
+    else:
+        # Halko-Martinsson-Tropp range finder with power iterations
+        basis = centered @ np.random.default_rng(seed).standard_normal((n, rank))
+        for _ in range(power_iterations):
+            basis = np.linalg.qr(basis)[0]
+            basis = centered @ (centered.T @ basis)
+        basis = np.linalg.qr(basis)[0]
+        _, singular_values, vt = np.linalg.svd(basis.T @ centered, full_matrices=False)
+    loadings = vt[:k].T * singular_values[:k]
+    idiosyncratic = np.clip(variance - (loadings ** 2).sum(axis=1), 1e-12, None)
+    return loadings, idiosyncratic
+
+def cholesky_or_none(covariance):
+    """Cholesky factor, or None when the covariance is singular (n_assets >= n_days)"""
+    try:
+        return np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        return None
+
+def read_npz_from_s3(s3_client, bucket, key):
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    with np.load(BytesIO(obj['Body'].read()), allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+def write_npz_to_s3(s3_client, bucket, key, arrays):
+    buffer = BytesIO()
+    np.savez(buffer, **arrays)
+    buffer.seek(0)
+    s3_client.upload_fileobj(buffer, bucket, key)
+
 def lambda_handler(event, context):
     raw_bucket = 'monte-carlo-raw-data-william-chang'
-    # Replace with the latest raw data file name or make dynamic
-    raw_key = 'raw_data/20250601.csv'
-    processed_bucket = 'monte-carlo-raw-data-william-chang' 
-    returns_key = 'processed_data/portfolio_returns.csv'
+    # Replace with the latest raw data file name or pass it in the event
+    raw_key = (event or {}).get('raw_key', 'raw_data/20250601.csv')
+    processed_bucket = 'monte-carlo-raw-data-william-chang'
     stats_key = 'processed_data/portfolio_stats.csv'
-    s3_client = boto3.client('s3')
 
     try:
         # Read raw data from S3
@@ -19,33 +213,57 @@ def lambda_handler(event, context):
         data = pd.read_csv(response['Body'], index_col=0, parse_dates=True)
         print(f"Read raw data from s3://{raw_bucket}/{raw_key}")
 
-        # Calculate daily returns (percentage change)
-        returns = data.pct_change().dropna()
-        print(f"Calculated daily returns for {len(returns)} trading days")
+        # Daily returns (percentage change); only rows after the stored state are folded in
+        returns_history = data.pct_change().iloc[1:]
+        state = read_npz_from_s3(s3_client, processed_bucket, state_key)
+        if state is not None:
+            state = reindex_state(state, returns_history)
+        if state is None:
+            print("No reusable covariance state; rebuilding from full history")
+            state = empty_state(list(returns_history.columns))
+            new_returns = returns_history.dropna()
+        else:
+            new_returns = returns_history.loc[returns_history.index > pd.Timestamp(str(state['last_date']))].dropna()
+        state = update_state(state, new_returns)
+        print(f"Folded {len(new_returns)} new trading days into {int(state['count'])} days of statistics")
 
-        # Calculate statistical parameters for Monte Carlo simulations
         # Annualize metrics assuming 252 trading days per year
-        mean_returns = returns.mean() * 252  # Annualized mean returns
-        volatility = returns.std() * np.sqrt(252)  # Annualized volatility
-        covariance = returns.cov() * 252  # Annualized covariance matrix ()
-        
+        mean_returns, volatility, covariance = covariance_from_state(state)
+        asset_names = list(state['asset_names'])
+        factor_loadings, idiosyncratic_var = factor_model(*factor_window(state, returns_history),
+                                                          np.diag(covariance))
+        cholesky = cholesky_or_none(covariance)
+        if cholesky is None:
+            print(f"Covariance of {len(asset_names)} assets is not positive definite; "
+                  "only the factor model (COVARIANCE_MODEL=factor) can simulate it")
+
         stats = pd.DataFrame({
             'MeanReturn_Annual': mean_returns,
             'Volatility_Annual': volatility
-        })
+        }, index=asset_names)
 
-        # Save daily returns to temporary file and upload to S3
-        returns_file = '/tmp/portfolio_returns.csv'
-        returns.to_csv(returns_file)
-        s3_client.upload_file(returns_file, processed_bucket, returns_key)
-        print(f"Daily returns uploaded to s3://{processed_bucket}/{returns_key}")
+        write_npz_to_s3(s3_client, processed_bucket, state_key, state)
+        # The simulator loads this directly instead of re-deriving it from returns
+        artifact = {
+            'asset_names': np.array(asset_names),
+            'mean_returns': mean_returns,
+            'covariance': covariance,
+            'factor_loadings': factor_loadings,
+            'idiosyncratic_var': idiosyncratic_var,
+            'method': np.array(covariance_method),
+            'as_of': state['last_date'],
+        }
+        if cholesky is not None:
+            artifact['cholesky'] = cholesky
+        write_npz_to_s3(s3_client, processed_bucket, covariance_key, artifact)
+        print(f"Covariance ({covariance_method}) uploaded to s3://{processed_bucket}/{covariance_key}")
 
         # Save stats (mean returns and volatility) to temporary file and upload to S3
         stats_file = '/tmp/portfolio_stats.csv'
         stats.to_csv(stats_file)
         s3_client.upload_file(stats_file, processed_bucket, stats_key)
         print(f"Summary stats uploaded to s3://{processed_bucket}/{stats_key}")
-        
+
         return {
             'statusCode': 200,
             'body': json.dumps(f"Processed data and stats uploaded to s3://{processed_bucket}")
@@ -56,4 +274,4 @@ def lambda_handler(event, context):
         return {
             'statusCode': 500,
             'body': json.dumps(error_msg)
-        }
\ No newline at end of file
+        }
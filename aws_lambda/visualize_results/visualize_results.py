@@ -1,14 +1,29 @@
 import pandas as pd
 import boto3
-import matplotlib.pyplot as plt
 from datetime import datetime
 import numpy as np
 import io
+import json
+import os
+import threading
 
 # AWS Configuration
 region = 'us-east-1'
 bucket = 'monte-carlo-raw-data-william-chang'
-simulations_key = 'processed_data/sim_results_combined.csv'
+# Every portfolio; only written when combine_results ran with combine_full_results
+simulations_key = 'processed_data/sim_results_combined.npz'
+# Merged per-job partial aggregates (top-k Sharpe, bottom-k volatility, frontier)
+summary_key = 'processed_data/sim_summary_combined.npz'
+# Exact Pareto frontier index written by combine_results, sorted by volatility
+frontier_key = 'processed_data/efficient_frontier.npz'
+# Only these result columns are loaded from the combined file
+plot_columns = ['simulation_id', 'returns', 'volatility', 'sharpe_ratio']
+
+# Rendering: above density_threshold portfolios, both plots are drawn from one
+# shared 2D (volatility, return) grid instead of a per-point scatter
+render_mode = 'auto'  # 'auto', 'scatter' or 'density'
+density_threshold = 100000
+density_bins = 400
 
 # Portfolio parameters
 initial_portfolio_value = 100000
@@ -17,16 +32,36 @@ num_days = 252
 # Initialize AWS clients
 s3_client = boto3.client('s3', region_name=region)
 
-def fetch_csv_from_s3(bucket, key):
-    """Fetch CSV data from S3"""
+# matplotlib is the slowest import here; it is loaded on first use (see pyplot)
+_pyplot = None
+# The handler warms pyplot on a background thread, so the import can race a plot
+_pyplot_lock = threading.Lock()
+
+def pyplot():
+    """matplotlib.pyplot, imported on first use with the headless Agg backend preselected"""
+    global _pyplot
+    with _pyplot_lock:
+        if _pyplot is None:
+            # The Lambda home directory is read-only; keep the font cache for warm starts
+            os.environ.setdefault('MPLCONFIGDIR', '/tmp/matplotlib')
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot
+            _pyplot = matplotlib.pyplot
+    return _pyplot
+
+def fetch_results_from_s3(bucket, key, columns):
+    """Fetch the requested columns of an .npz results file from S3, with its metadata"""
     try:
-        print(f"Fetching CSV from s3://{bucket}/{key}")
+        print(f"Fetching results from s3://{bucket}/{key}")
         response = s3_client.get_object(Bucket=bucket, Key=key)
-        df = pd.read_csv(response['Body'], index_col=0 if 'simulation_id' in pd.read_csv(response['Body'], nrows=0).columns else None)
-        print(f"Successfully loaded CSV with {len(df)} rows")
-        return df
+        with np.load(io.BytesIO(response['Body'].read()), allow_pickle=False) as results:
+            metadata = json.loads(str(results['__metadata__']))
+            df = pd.DataFrame({name: results[name] for name in columns})
+        print(f"Successfully loaded {len(df)} rows from {metadata.get('num_shards', 1)} shard(s)")
+        return df, metadata
     except Exception as e:
-        print(f"Error fetching CSV from S3: {str(e)}")
+        print(f"Error fetching results from S3: {str(e)}")
         raise
 
 def identify_optimal_portfolios(results_df, initial_portfolio_value, num_days):
@@ -79,12 +114,37 @@ def upload_plot_to_s3(fig, bucket, s3_key):
         print(f"Failed to upload plot: {str(e)}")
         raise
 
-def plot_risk_return_scatter(all_portfolios_df, optimal_df, bucket, s3_key):
+def risk_return_density(all_portfolios_df, bins=density_bins):
+    """Bin (volatility, return) once: portfolio counts and mean Sharpe ratio per cell"""
+    volatility = all_portfolios_df['volatility'].to_numpy()
+    returns = all_portfolios_df['returns'].to_numpy()
+    sharpe = all_portfolios_df['sharpe_ratio'].to_numpy()
+    finite = np.isfinite(volatility) & np.isfinite(returns) & np.isfinite(sharpe)
+    counts, vol_edges, ret_edges = np.histogram2d(volatility[finite], returns[finite], bins=bins)
+    sharpe_sums, _, _ = np.histogram2d(volatility[finite], returns[finite], bins=[vol_edges, ret_edges],
+                                       weights=sharpe[finite])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_sharpe = np.ma.masked_where(counts == 0, sharpe_sums / counts)
+    return {'mean_sharpe': mean_sharpe, 'counts': counts,
+            'extent': (vol_edges[0], vol_edges[-1], ret_edges[0], ret_edges[-1])}
+
+def draw_portfolios(ax, all_portfolios_df, density=None, label='All Portfolios'):
+    """Draw every portfolio coloured by Sharpe ratio, as a scatter or a binned raster image"""
+    if density is None:
+        artist = ax.scatter(all_portfolios_df['volatility'], all_portfolios_df['returns'],
+                            c=all_portfolios_df['sharpe_ratio'], cmap='viridis', alpha=0.5, label=label)
+        ax.figure.colorbar(artist, ax=ax, label='Sharpe Ratio')
+    else:
+        # Histogram axes are (volatility, return); imshow wants rows = y
+        artist = ax.imshow(density['mean_sharpe'].T, origin='lower', extent=density['extent'],
+                           aspect='auto', cmap='viridis', interpolation='nearest', rasterized=True)
+        ax.figure.colorbar(artist, ax=ax, label='Mean Sharpe Ratio')
+
+def plot_risk_return_scatter(all_portfolios_df, optimal_df, bucket, s3_key, density=None, label='All Portfolios'):
     """Plot risk-return scatter and upload to S3"""
+    plt = pyplot()
     fig, ax = plt.subplots(figsize=(10, 6))
-    scatter = ax.scatter(all_portfolios_df['volatility'], all_portfolios_df['returns'],
-                         c=all_portfolios_df['sharpe_ratio'], cmap='viridis', alpha=0.5, label='All Portfolios')
-    plt.colorbar(scatter, ax=ax, label='Sharpe Ratio')
+    draw_portfolios(ax, all_portfolios_df, density, label)
     if not optimal_df.empty:
         for _, opt in optimal_df.iterrows():
             ax.scatter(opt['volatility'], opt['returns'], s=200, marker='*',
@@ -98,17 +158,12 @@ def plot_risk_return_scatter(all_portfolios_df, optimal_df, bucket, s3_key):
     upload_plot_to_s3(fig, bucket, s3_key)
     plt.close(fig)
 
-def plot_efficient_frontier(all_portfolios_df, optimal_df, bucket, s3_key):
+def plot_efficient_frontier(all_portfolios_df, optimal_df, frontier, bucket, s3_key, density=None,
+                            label='All Portfolios'):
     """Plot efficient frontier and upload to S3"""
-    df_sorted = all_portfolios_df.sort_values(by='volatility')
-    df_sorted['RiskBin'] = pd.qcut(df_sorted['volatility'], q=50, duplicates='drop')
-    frontier = df_sorted.loc[df_sorted.groupby('RiskBin')['returns'].idxmax()]
-    frontier = frontier.sort_values(by='volatility')
-    
+    plt = pyplot()
     fig, ax = plt.subplots(figsize=(10, 6))
-    scatter = ax.scatter(all_portfolios_df['volatility'], all_portfolios_df['returns'],
-                         c=all_portfolios_df['sharpe_ratio'], cmap='viridis', alpha=0.5, label='All Portfolios')
-    plt.colorbar(scatter, ax=ax, label='Sharpe Ratio')
+    draw_portfolios(ax, all_portfolios_df, density, label)
     ax.plot(frontier['volatility'], frontier['returns'], 'r-', label='Efficient Frontier')
     if not optimal_df.empty:
         for _, opt in optimal_df.iterrows():
@@ -127,15 +182,28 @@ def lambda_handler(event=None, context=None):
     """Main Lambda entry point"""
     try:
         print("Starting visualization process at " + datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        # Overlap the matplotlib import with the S3 reads below
+        threading.Thread(target=pyplot, daemon=True).start()
+
+        # The optima come from the small merged summary; full results are only for plotting
+        summary_portfolios, summary_metadata = fetch_results_from_s3(bucket, summary_key, plot_columns)
+        optimal_portfolios = identify_optimal_portfolios(summary_portfolios, initial_portfolio_value, num_days)
+        frontier, _ = fetch_results_from_s3(bucket, frontier_key, plot_columns)
+        if summary_metadata.get('full_results'):
+            all_portfolios, _ = fetch_results_from_s3(bucket, simulations_key, ['returns', 'volatility', 'sharpe_ratio'])
+            label = 'All Portfolios'
+        else:
+            # Without combined full results, plot every job's top-k and frontier rows
+            all_portfolios, label = summary_portfolios, 'Top Sharpe, Min Volatility and Frontier Portfolios'
 
-        all_portfolios = fetch_csv_from_s3(bucket, simulations_key)
-        optimal_portfolios = identify_optimal_portfolios(all_portfolios, initial_portfolio_value, num_days)
+        use_density = render_mode == 'density' or (render_mode == 'auto' and len(all_portfolios) > density_threshold)
+        density = risk_return_density(all_portfolios) if use_density else None
 
         scatter_plot_key = 'plots/risk_return_scatter.png'
         frontier_plot_key = 'plots/efficient_frontier.png'
 
-        plot_risk_return_scatter(all_portfolios, optimal_portfolios, bucket, scatter_plot_key)
-        plot_efficient_frontier(all_portfolios, optimal_portfolios, bucket, frontier_plot_key)
+        plot_risk_return_scatter(all_portfolios, optimal_portfolios, bucket, scatter_plot_key, density, label)
+        plot_efficient_frontier(all_portfolios, optimal_portfolios, frontier, bucket, frontier_plot_key, density, label)
 
         print("Visualization completed successfully at " + datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         return {
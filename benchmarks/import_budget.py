@@ -0,0 +1,101 @@
+"""Measure each Lambda handler's cold-start import time against a budget.
+
+Every handler module is imported in a fresh interpreter (module-level code
+included, so client construction counts), the best of --repeat runs is
+reported as one JSON line, and the exit status is non-zero if any handler
+exceeds its budget. --detail prints the slowest imports from -X importtime.
+
+    python benchmarks/import_budget.py
+    python benchmarks/import_budget.py --detail visualize_results
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Milliseconds of init-phase import per handler: about 1.5x the best-of-7
+# baseline (fetch/stats ~500-550 ms, optimize/combine ~400-450 ms, visualize
+# ~630 ms), which absorbs run-to-run noise of ~100-150 ms but still fails on an
+# eager scipy.optimize (~+270 ms) or matplotlib.pyplot (~+500 ms) import
+HANDLER_BUDGETS_MS = {
+    'fetch_data': ('aws_lambda/fetch_data/fetch_data.py', 850),
+    'statistical_parameters': ('aws_lambda/statistical_parameters/get_statistical_paramteters.py', 850),
+    'optimize_portfolio': ('aws_lambda/optimize_portfolio/optimize_portfolio.py', 700),
+    'combine_results': ('aws_lambda/combine_results/combine_results.py', 700),
+    'visualize_results': ('aws_lambda/visualize_results/visualize_results.py', 950),
+}
+
+import_snippet = """
+import importlib.util, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('handler', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def handler_env():
+    env = dict(os.environ)
+    # Module-level boto3 clients need a region, as Lambda always provides one
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('MPLCONFIGDIR', '/tmp/matplotlib')
+    return env
+
+
+def measure_import_ms(path, repeat=7):
+    """Best-of-repeat import time in ms, each in a fresh interpreter"""
+    timings = []
+    for _ in range(repeat):
+        child = subprocess.run([sys.executable, '-c', import_snippet, os.path.join(repo_root, path)],
+                               capture_output=True, text=True, env=handler_env())
+        if child.returncode != 0:
+            raise RuntimeError(child.stderr.strip().splitlines()[-1])
+        timings.append(float(child.stdout.strip().splitlines()[-1]))
+    return min(timings)
+
+
+def slowest_imports(path, top=15):
+    """(cumulative_us, module) for the slowest imports, from python -X importtime"""
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-c', import_snippet, os.path.join(repo_root, path)],
+                           capture_output=True, text=True, env=handler_env())
+    rows = []
+    for line in child.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, module = line.split('|')
+            rows.append((int(cumulative), module.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check Lambda handler import times against budgets")
+    parser.add_argument('handlers', nargs='*', default=list(HANDLER_BUDGETS_MS))
+    parser.add_argument('--repeat', type=int, default=7,
+                        help="Fresh-interpreter imports per handler; the best is compared")
+    parser.add_argument('--detail', action='store_true', help="Show the slowest imports per handler")
+    args = parser.parse_args(argv)
+
+    over_budget = False
+    for name in args.handlers:
+        path, budget_ms = HANDLER_BUDGETS_MS[name]
+        try:
+            import_ms = measure_import_ms(path, args.repeat)
+        except RuntimeError as e:
+            print(json.dumps({'handler': name, 'error': str(e)}))
+            over_budget = True
+            continue
+        within = import_ms <= budget_ms
+        over_budget |= not within
+        print(json.dumps({'handler': name, 'import_ms': round(import_ms, 1), 'budget_ms': budget_ms,
+                          'within_budget': within}))
+        if args.detail:
+            for cumulative_us, module in slowest_imports(path):
+                print(f"    {cumulative_us / 1000:8.1f} ms {module}")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
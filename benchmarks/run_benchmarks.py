@@ -0,0 +1,187 @@
+"""Throughput benchmarks for the simulator, combiner and frontier/plotting stages.
+
+Sweeps num_assets x num_simulations x num_days x num_portfolios over a synthetic
+covariance artifact, running monte_carlo_sim -> combine_results ->
+visualize_results in-process against the local S3/DynamoDB stand-ins. Every
+configuration runs in a fresh subprocess so peak RSS is per configuration.
+Each result is one JSON line; append them to a history file and compare new
+runs against it to catch regressions:
+
+    python benchmarks/run_benchmarks.py --output benchmarks.jsonl
+    python benchmarks/run_benchmarks.py --baseline benchmarks.jsonl --threshold 0.2
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo_root, 'local_pipeline'))
+sys.path.insert(0, os.path.join(repo_root, 'aws_batch'))
+
+from metrics import peak_rss_mb  # noqa: E402
+from run_pipeline import STAGES, bucket, run_pipeline  # noqa: E402
+from storage import MemoryDynamoDB, MemoryS3Client  # noqa: E402
+
+covariance_key = 'processed_data/covariance.npz'
+benchmark_stages = ('monte_carlo_sim', 'combine_results', 'visualize_results')
+noise_floor_seconds = 0.05  # Stage time differences below this are never regressions
+
+
+def synthetic_covariance(num_assets, seed=0, num_factors=3):
+    """covariance.npz bytes for a one-factor market with idiosyncratic noise (annualized)"""
+    rng = np.random.default_rng(seed)
+    beta = rng.uniform(0.5, 1.5, num_assets)
+    covariance = 0.04 * np.outer(beta, beta) + np.diag(rng.uniform(0.02, 0.2, num_assets))
+    mean_returns = rng.uniform(0.02, 0.3, num_assets)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    top = np.argsort(eigenvalues)[::-1][:num_factors]
+    loadings = eigenvectors[:, top] * np.sqrt(eigenvalues[top])
+    buffer = io.BytesIO()
+    np.savez(buffer,
+             asset_names=np.array([f'ASSET{i:04d}' for i in range(num_assets)]),
+             mean_returns=mean_returns,
+             covariance=covariance,
+             cholesky=np.linalg.cholesky(covariance),
+             factor_loadings=loadings,
+             idiosyncratic_var=np.clip(np.diag(covariance) - (loadings ** 2).sum(axis=1), 1e-12, None),
+             method=np.array('synthetic'),
+             as_of=np.array('NaT', dtype='datetime64[D]'))
+    return buffer.getvalue()
+
+
+def metric_lines(output):
+    """Embedded Metric Format documents printed by the stages"""
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+
+def run_config(config):
+    """Run one configuration in this process and return its result record"""
+    s3_client, dynamodb = MemoryS3Client(), MemoryDynamoDB()
+    s3_client.put_object(Bucket=bucket, Key=covariance_key, Body=synthetic_covariance(config['num_assets']))
+    env = {
+        'NUM_PORTFOLIOS': config['num_portfolios'],
+        'NUM_WORKERS': config['num_workers'],
+        'SIMULATION_MODE': config['simulation_mode'],
+    }
+    overrides = {'monte_carlo_sim': {'num_simulations': config['num_simulations'], 'num_days': config['num_days']}}
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        _, _, report = run_pipeline(array_size=config['array_size'], env=env, overrides=overrides,
+                                    from_stage='monte_carlo_sim',
+                                    stages=[stage for stage in STAGES if stage.name in benchmark_stages],
+                                    s3_client=s3_client, dynamodb=dynamodb, full_results=True)
+
+    jobs = [line for line in metric_lines(output.getvalue()) if line.get('Stage') == 'monte-carlo-sim']
+    simulate_seconds = sum(job['simulate_seconds'] for job in jobs)
+    return {
+        'benchmark': 'pipeline',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'config': config,
+        'stages': {entry['stage']: entry['seconds'] for entry in report},
+        'simulate_seconds': simulate_seconds,
+        'paths_per_second': sum(job['paths'] for job in jobs) / simulate_seconds,
+        'portfolios_per_second': sum(job['portfolios'] for job in jobs) / simulate_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_child_rss_mb': max([job['peak_child_rss_mb'] for job in jobs], default=0.0),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_root,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+def find_regressions(record, baseline, threshold):
+    """Stages (and throughput) more than threshold slower than the latest matching baseline"""
+    reference = baseline.get(config_key(record['config']))
+    if reference is None:
+        return []
+    regressions = []
+    for stage, seconds in record['stages'].items():
+        before = reference['stages'].get(stage)
+        if before and seconds > before * (1 + threshold) and seconds - before > noise_floor_seconds:
+            regressions.append(f"{stage}: {before:.3f}s -> {seconds:.3f}s")
+    if record['paths_per_second'] < reference['paths_per_second'] / (1 + threshold):
+        regressions.append(f"paths/sec: {reference['paths_per_second']:.0f} -> {record['paths_per_second']:.0f}")
+    return regressions
+
+
+def load_baseline(path):
+    """Latest record per configuration from a JSON-lines history file"""
+    baseline = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                baseline[config_key(record['config'])] = record
+    return baseline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulation pipeline stages")
+    parser.add_argument('--assets', type=int, nargs='+', default=[8, 64])
+    parser.add_argument('--simulations', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--days', type=int, nargs='+', default=[63, 252])
+    parser.add_argument('--portfolios', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--mode', default='shared', choices=['shared', 'independent'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--array-size', type=int, default=1)
+    parser.add_argument('--output', help="Append result lines to this JSON-lines history file")
+    parser.add_argument('--baseline', help="History file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed slowdown fraction")
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        print(json.dumps(run_config(json.loads(args.single))))
+        return 0
+
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    failed = False
+    for num_assets, num_simulations, num_days, num_portfolios in itertools.product(
+            args.assets, args.simulations, args.days, args.portfolios):
+        config = {
+            'num_assets': num_assets,
+            'num_simulations': num_simulations,
+            'num_days': num_days,
+            'num_portfolios': num_portfolios,
+            'simulation_mode': args.mode,
+            'num_workers': args.workers,
+            'array_size': args.array_size,
+        }
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', json.dumps(config)],
+                               capture_output=True, text=True)
+        if child.returncode != 0:
+            print(child.stderr, file=sys.stderr)
+            failed = True
+            continue
+        line = child.stdout.strip().splitlines()[-1]
+        record = json.loads(line)
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + '\n')
+        for regression in find_regressions(record, baseline, args.threshold):
+            print(f"REGRESSION {config_key(config)} {regression}", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""Run the Step Functions chain in one process.
+
+Each stage is the unmodified lambda_handler or Batch main(), loaded from its
+file with boto3 pointed at in-memory S3/DynamoDB stand-ins. Stage outputs are
+handed to the next stage in memory; only keys under the checkpoint prefixes
+are written to the storage backend (a local directory or an S3-compatible
+client).
+
+    python local_pipeline/run_pipeline.py --raw-data aws_lambda/fetch_data/20250601.csv \\
+        --checkpoint-dir /tmp/pipeline --array-size 2 --env NUM_PORTFOLIOS=100
+"""
+import argparse
+import contextlib
+import importlib.util
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import boto3
+
+from storage import LocalDirectoryStorage, MemoryDynamoDB, MemoryS3Client, ThrottledDynamoDB
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+bucket = 'monte-carlo-raw-data-william-chang'
+# Stage outputs persisted at checkpoints; everything else stays in memory
+checkpoint_prefixes = ('raw_data/', 'price_store/', 'processed_data/covariance', 'processed_data/sim_results_',
+                       'processed_data/sim_summary_', 'processed_data/efficient_frontier',
+                       'processed_data/optimized_portfolios', 'plots/')
+
+
+class Stage:
+    def __init__(self, name, path, entry='lambda_handler', depends_on=(), array=False):
+        self.name = name
+        self.path = path
+        self.entry = entry
+        self.depends_on = tuple(depends_on)
+        self.array = array  # Run once per AWS_BATCH_JOB_ARRAY_INDEX
+
+
+STAGES = [
+    Stage('fetch_data', 'aws_lambda/fetch_data/fetch_data.py'),
+    Stage('statistical_parameters', 'aws_lambda/statistical_parameters/get_statistical_paramteters.py',
+          depends_on=['fetch_data']),
+    Stage('optimize_portfolio', 'aws_lambda/optimize_portfolio/optimize_portfolio.py',
+          depends_on=['statistical_parameters']),
+    Stage('monte_carlo_sim', 'aws_batch/monte-carlo-sim.py', entry='main',
+          depends_on=['statistical_parameters'], array=True),
+    Stage('combine_results', 'aws_lambda/combine_results/combine_results.py', depends_on=['monte_carlo_sim']),
+    Stage('visualize_results', 'aws_lambda/visualize_results/visualize_results.py', depends_on=['combine_results']),
+]
+
+
+def topological_order(stages):
+    """Stages ordered so every dependency runs first (stable for independent stages)"""
+    by_name = {stage.name: stage for stage in stages}
+    ordered, done = [], set()
+
+    def visit(stage, path=()):
+        if stage.name in done:
+            return
+        if stage.name in path:
+            raise ValueError(f"Pipeline cycle through {stage.name}")
+        for dependency in stage.depends_on:
+            if dependency in by_name:
+                visit(by_name[dependency], path + (stage.name,))
+        done.add(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+@contextlib.contextmanager
+def patched_aws(s3_client, dynamodb):
+    """Route boto3.client('s3') and boto3.resource('dynamodb') to the stand-ins"""
+    original_client, original_resource = boto3.client, boto3.resource
+    boto3.client = lambda service_name, *args, **kwargs: s3_client
+    boto3.resource = lambda service_name, *args, **kwargs: dynamodb
+    try:
+        yield
+    finally:
+        boto3.client, boto3.resource = original_client, original_resource
+
+
+@contextlib.contextmanager
+def stage_environment(env):
+    """Module-level configuration is read from the environment at import time"""
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update({name: str(value) for name, value in env.items()})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def load_stage(stage, overrides=None):
+    """Import a stage file fresh so its module-level configuration sees the current environment"""
+    path = os.path.join(repo_root, stage.path)
+    # The Batch job imports its sibling modules by name
+    if os.path.dirname(path) not in sys.path:
+        sys.path.insert(0, os.path.dirname(path))
+    module_spec = importlib.util.spec_from_file_location(stage.name, path)
+    module = importlib.util.module_from_spec(module_spec)
+    # Registered so worker processes can unpickle the Batch job's functions
+    sys.modules[stage.name] = module
+    module_spec.loader.exec_module(module)
+    for attribute, value in (overrides or {}).items():
+        setattr(module, attribute, value)
+    return module
+
+
+def run_stage(stage, event, overrides):
+    module = load_stage(stage, overrides)
+    if stage.entry == 'main':
+        result = module.main()
+    else:
+        result = getattr(module, stage.entry)(event, None)
+    if not result or result.get('statusCode') != 200:
+        raise RuntimeError(f"Stage {stage.name} failed: {(result or {}).get('body')}")
+    return result
+
+
+def run_pipeline(storage=None, raw_data=None, array_size=1, env=None, overrides=None,
+                 skip=(), from_stage=None, stages=STAGES, s3_client=None, dynamodb=None, full_results=False):
+    """Run every selected stage in dependency order; returns (s3, dynamodb, report).
+    Pre-populated stand-ins can be passed in to seed a stage's inputs."""
+    s3_client = s3_client or MemoryS3Client(storage, checkpoint_prefixes)
+    dynamodb = dynamodb or MemoryDynamoDB()
+    env = dict(env or {})
+    env.setdefault('MPLBACKEND', 'Agg')
+    overrides = overrides or {}
+    skip = set(skip)
+
+    events = {}
+    if raw_data is not None:
+        # A local price file replaces the yfinance download
+        raw_key = f"raw_data/{os.path.basename(raw_data)}"
+        with open(raw_data, 'rb') as f:
+            s3_client.put_object(Bucket=bucket, Key=raw_key, Body=f.read())
+        events['statistical_parameters'] = {'raw_key': raw_key}
+        skip.add('fetch_data')
+    else:
+        events['statistical_parameters'] = {'raw_key': f"raw_data/{datetime.now().strftime('%Y%m%d')}.csv"}
+
+    ordered = topological_order(stages)
+    if from_stage is not None:
+        names = [stage.name for stage in ordered]
+        # Earlier stages are satisfied from checkpoints in storage
+        skip.update(names[:names.index(from_stage)])
+    # As Step Functions passes the array job's size (and id), so combine ignores
+    # shards left over from earlier runs; a resumed combine reads the checkpointed run
+    events['combine_results'] = {'array_size': array_size, 'combine_full_results': full_results}
+    if any(stage.array and stage.name not in skip for stage in ordered):
+        env.setdefault('RUN_ID', uuid.uuid4().hex)
+        events['combine_results']['run_id'] = env['RUN_ID']
+
+    report = []
+    with patched_aws(s3_client, dynamodb):
+        for stage in ordered:
+            if stage.name in skip:
+                continue
+            start = time.perf_counter()
+            job_indices = range(array_size) if stage.array else [None]
+            for job_index in job_indices:
+                stage_env = dict(env)
+                if job_index is not None:
+                    stage_env['AWS_BATCH_JOB_ARRAY_INDEX'] = str(job_index)
+                with stage_environment(stage_env):
+                    run_stage(stage, events.get(stage.name, {}), overrides.get(stage.name))
+            report.append({'stage': stage.name, 'seconds': time.perf_counter() - start, 'jobs': len(job_indices)})
+
+    if storage is not None:
+        dynamodb.dump(storage)
+    return s3_client, dynamodb, report
+
+
+def parse_assignments(values):
+    return dict(value.split('=', 1) for value in values or [])
+
+
+def parse_overrides(values):
+    """stage.attribute=value pairs; values are parsed as int/float where possible"""
+    overrides = {}
+    for name, value in parse_assignments(values).items():
+        stage, attribute = name.split('.', 1)
+        for cast in (int, float):
+            try:
+                value = cast(value)
+                break
+            except ValueError:
+                continue
+        overrides.setdefault(stage, {})[attribute] = value
+    return overrides
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Monte Carlo pipeline locally")
+    parser.add_argument('--raw-data', help="Price CSV to use instead of running fetch_data")
+    parser.add_argument('--checkpoint-dir', help="Directory for checkpointed stage outputs")
+    parser.add_argument('--array-size', type=int, default=1, help="Batch array jobs for monte_carlo_sim")
+    parser.add_argument('--env', action='append', help="NAME=VALUE stage environment variable")
+    parser.add_argument('--set', action='append', help="stage.attribute=value module override, "
+                                                       "e.g. monte_carlo_sim.num_simulations=500")
+    parser.add_argument('--skip', action='append', default=[], help="Stage to skip")
+    parser.add_argument('--from-stage', help="Resume at this stage using checkpoints for earlier ones")
+    parser.add_argument('--full-results', action='store_true',
+                        help="Have combine_results write every row and plot them all")
+    parser.add_argument('--throttle-dynamodb', type=float, metavar='FRACTION',
+                        help="Leave this fraction of every BatchWriteItem unprocessed to exercise retries")
+    args = parser.parse_args(argv)
+
+    storage = LocalDirectoryStorage(args.checkpoint_dir) if args.checkpoint_dir else None
+    dynamodb = ThrottledDynamoDB(args.throttle_dynamodb) if args.throttle_dynamodb is not None else None
+    _, dynamodb, report = run_pipeline(storage, args.raw_data, args.array_size, parse_assignments(args.env),
+                                       parse_overrides(args.set), args.skip, args.from_stage, dynamodb=dynamodb,
+                                       full_results=args.full_results)
+    for entry in report:
+        print(f"{entry['stage']:<24} {entry['jobs']:>3} job(s) {entry['seconds']:>9.2f}s")
+    if isinstance(dynamodb, ThrottledDynamoDB):
+        print(f"DynamoDB: {dynamodb.calls} BatchWriteItem calls, {dynamodb.unprocessed_returned} items returned "
+              f"unprocessed, {sum(len(items) for items in dynamodb.tables.values())} items stored")
+
+
+if __name__ == "__main__":
+    main()
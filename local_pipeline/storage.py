@@ -0,0 +1,220 @@
+import io
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+
+def no_such_key(key):
+    return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f"No such key: {key}"}}, 'GetObject')
+
+
+class LocalDirectoryStorage:
+    """Checkpoint backend: objects are files under <root>/<bucket>/<key>"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def get(self, bucket, key):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, bucket, key, data):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def delete(self, bucket, key):
+        path = self._path(bucket, key)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def list(self, bucket, prefix=''):
+        """(key, size, last_modified) for stored objects under prefix"""
+        base = os.path.join(self.root, bucket)
+        result = []
+        for directory, _, names in os.walk(base):
+            for name in names:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, base).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    modified = datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+                    result.append((key, os.path.getsize(path), modified))
+        return result
+
+
+class S3Storage:
+    """Checkpoint backend over any boto3-compatible S3 client (real S3, MinIO, moto)"""
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def get(self, bucket, key):
+        try:
+            return self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def put(self, bucket, key, data):
+        self.s3_client.upload_fileobj(io.BytesIO(data), bucket, key)
+
+    def delete(self, bucket, key):
+        self.s3_client.delete_object(Bucket=bucket, Key=key)
+
+    def list(self, bucket, prefix=''):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        return [(obj['Key'], obj['Size'], obj['LastModified'])
+                for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+                for obj in page.get('Contents', [])]
+
+
+class MemoryS3Client:
+    """In-process stand-in for the subset of the boto3 S3 client the stages use.
+
+    Objects live in memory, so stage handoff costs no network round-trip.
+    Keys under ``checkpoint_prefixes`` are also written through to
+    ``storage``, and reads that miss memory fall back to it, so a run can
+    resume from an earlier run's checkpoints.
+    """
+
+    def __init__(self, storage=None, checkpoint_prefixes=()):
+        self.storage = storage
+        self.checkpoint_prefixes = tuple(checkpoint_prefixes)
+        self.objects = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def _store(self, bucket, key, data):
+        with self._lock:
+            self.objects[(bucket, key)] = (data, datetime.now(timezone.utc))
+            self.bytes_written += len(data)
+        if self.storage is not None and key.startswith(self.checkpoint_prefixes):
+            self.storage.put(bucket, key, data)
+
+    def _load(self, bucket, key):
+        entry = self.objects.get((bucket, key))
+        if entry is None and self.storage is not None:
+            data = self.storage.get(bucket, key)
+            if data is not None:
+                entry = (data, datetime.now(timezone.utc))
+                self.objects[(bucket, key)] = entry
+        if entry is None:
+            raise no_such_key(key)
+        self.bytes_read += len(entry[0])
+        return entry
+
+    def get_object(self, Bucket, Key, **kwargs):
+        data, modified = self._load(Bucket, Key)
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'LastModified': modified}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data, modified = self._load(Bucket, Key)
+        return {'ContentLength': len(data), 'LastModified': modified}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        self._store(Bucket, Key, data.encode() if isinstance(data, str) else bytes(data))
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        with open(Filename, 'rb') as f:
+            self._store(Bucket, Key, f.read())
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        self._store(Bucket, Key, Fileobj.read())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        if self.storage is not None:
+            self.storage.delete(Bucket, Key)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        listing = {}
+        if self.storage is not None:
+            for key, size, modified in self.storage.list(Bucket, Prefix):
+                listing[key] = (size, modified)
+        for (bucket, key), (data, modified) in list(self.objects.items()):
+            if bucket == Bucket and key.startswith(Prefix):
+                listing[key] = (len(data), modified)
+        contents = [{'Key': key, 'Size': size, 'LastModified': modified}
+                    for key, (size, modified) in sorted(listing.items())]
+        return {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': False}
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        client = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield client.list_objects_v2(**kwargs)
+
+        return Paginator()
+
+
+class MemoryTable:
+    def __init__(self, items):
+        self.items = items
+
+    def put_item(self, Item, **kwargs):
+        self.items.append(Item)
+        return {}
+
+
+class MemoryDynamoDB:
+    """In-process stand-in for the boto3 DynamoDB resource (Table.put_item and batch_write_item)"""
+
+    def __init__(self):
+        self.tables = {}
+
+    def Table(self, name):
+        return MemoryTable(self.tables.setdefault(name, []))
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        for table, requests in RequestItems.items():
+            self.tables.setdefault(table, []).extend(request['PutRequest']['Item'] for request in requests)
+        return {'UnprocessedItems': {}}
+
+    def dump(self, storage, bucket='dynamodb'):
+        """Checkpoint every table as JSON lines (Decimals as strings)"""
+        for table, items in self.tables.items():
+            lines = ''.join(json.dumps(item, default=str) + '\n' for item in items)
+            storage.put(bucket, f'{table}.jsonl', lines.encode())
+
+
+class ThrottledDynamoDB(MemoryDynamoDB):
+    """MemoryDynamoDB whose batch_write_item leaves the trailing fraction of each
+    request unprocessed, as DynamoDB does when a table is throttled. A fraction
+    below 1 converges in a few retries; 1.0 never accepts anything."""
+
+    def __init__(self, unprocessed_fraction=0.5):
+        super().__init__()
+        self.unprocessed_fraction = unprocessed_fraction
+        self.calls = 0
+        self.unprocessed_returned = 0
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.calls += 1
+        processed, unprocessed = {}, {}
+        for table, requests in RequestItems.items():
+            accepted = len(requests) - int(len(requests) * self.unprocessed_fraction)
+            processed[table] = requests[:accepted]
+            if accepted < len(requests):
+                unprocessed[table] = requests[accepted:]
+                self.unprocessed_returned += len(requests) - accepted
+        super().batch_write_item(processed)
+        return {'UnprocessedItems': unprocessed}
+